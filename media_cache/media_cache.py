@@ -0,0 +1,532 @@
+import asyncio
+import tempfile
+import hashlib
+import aiohttp
+import shutil
+import time
+import os
+
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs, urlencode
+from psycopg2.extras import Json
+from youtube_dl import YoutubeDL
+from tinytag import TinyTag
+
+from jshbot import utilities, configurations, plugins, data, logger
+from jshbot.exceptions import ConfiguredBotException, BotException
+from jshbot.commands import Command, SubCommand, Response
+
+__version__ = '0.1.0'
+CBException = ConfiguredBotException('Media cache')
+uses_configuration = True
+
+# Only these keys of the youtube_dl information are kept
+INFO_KEYS = (
+    'webpage_url', 'title', 'duration', 'thumbnail', 'like_count', 'dislike_count',
+    'view_count', 'description', 'upload_date', 'uploader', 'direct', 'url', 'ext',
+    'http_headers')
+FORMAT_KEYS = ('format_id', 'url', 'ext', 'acodec', 'abr', 'filesize', 'http_headers')
+YDL_OPTIONS = {'format': 'bestaudio/best', 'noplaylist': True}
+PROBE_CHUNK = 256 * 1024  # Size of the first range request, doubled for each one after
+PROBE_TIMEOUT = 30
+
+
+class MetadataCache():
+    """Shared cache of youtube_dl lookups, kept in memory and in the database.
+
+    Entries are keyed by the normalized URL or search query. Metadata expires after
+    metadata_ttl seconds. Stream URLs expire on their own schedule, and are refreshed
+    from the resolved page URL instead of repeating the original lookup.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        config = configurations.get(bot, __name__)
+        self.metadata_ttl = config['metadata_ttl']
+        self.stream_ttl = config['stream_ttl']
+        self.memory_limit = config['memory_limit']
+        self.entries = OrderedDict()  # Key: entry dictionary
+        self.pending = {}  # Key: lookup future
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, query, streams=False):
+        """Gets the information for the URL or ytsearch: query."""
+        key = get_key(query)
+        entry = self._load(key)
+        current_time = time.time()
+        if entry and current_time - entry['fetched'] < self.metadata_ttl:
+            if not streams or current_time < entry['expires']:
+                self.hits += 1
+                return entry['info']
+            return await self._lookup(key, entry['info']['webpage_url'], refresh=entry)
+        self.misses += 1
+        return await self._lookup(key, query)
+
+    def add(self, info, query=None):
+        """Adds already extracted information (such as playlist entries)."""
+        keys = [get_key(query)] if query else []
+        return self._add(info, keys)
+
+    def _add(self, info, keys, fetched=None):
+        """Stores the information under the given keys and its own page URL."""
+        info = _compact_info(info)
+        entry = {
+            'info': info, 'fetched': fetched or int(time.time()),
+            'expires': self._get_expiry(info)}
+        for key in set(keys + [get_key(info['webpage_url'])]):
+            self._store(key, entry)
+        return info
+
+    async def _lookup(self, key, query, refresh=None):
+        """Runs youtube_dl once per key, even with concurrent requests."""
+        if key in self.pending:
+            return await asyncio.shield(self.pending[key])
+        future = asyncio.ensure_future(self._extract(key, query, refresh=refresh))
+        self.pending[key] = future
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if self.pending.get(key) is future:
+                del self.pending[key]
+
+    async def _extract(self, key, query, refresh=None):
+        downloader = YoutubeDL(YDL_OPTIONS)
+        if refresh:
+            logger.debug("Refreshing stream URLs for %s", key)
+        info = await utilities.future(downloader.extract_info, query, download=False)
+        if query.lower().startswith('ytsearch:'):  # Select first result on search
+            info = info['entries'][0]
+        if refresh:  # Only stream data is replaced
+            new_info = dict(refresh['info'])
+            for info_key in ('url', 'formats', 'http_headers'):
+                if info_key in info:
+                    new_info[info_key] = info[info_key]
+            info = new_info
+            return self._add(info, [key], fetched=refresh['fetched'])
+        return self._add(info, [key])
+
+    def _get_expiry(self, info):
+        """Gets when the stream URLs of the given information expire."""
+        current_time = int(time.time())
+        if info.get('direct'):
+            return current_time + self.metadata_ttl
+        stream_url = info.get('url') or (info.get('formats') or [{}])[0].get('url')
+        if stream_url:
+            expire = parse_qs(urlparse(stream_url).query).get('expire')
+            if expire and expire[0].isdigit():
+                return min(int(expire[0]) - 60, current_time + self.stream_ttl)
+        return current_time + self.stream_ttl
+
+    def _load(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        cursor = data.db_select(
+            self.bot, from_arg='media_metadata', where_arg='key=%s', input_args=[key])
+        result = cursor.fetchone() if cursor else None
+        if result:
+            entry = {'info': result.info, 'fetched': result.fetched, 'expires': result.expires}
+            self._remember(key, entry)
+            return entry
+
+    def _store(self, key, entry):
+        exists = key in self.entries
+        if not exists:
+            cursor = data.db_select(
+                self.bot, from_arg='media_metadata', where_arg='key=%s', input_args=[key])
+            exists = bool(cursor.fetchone()) if cursor else False
+        input_args = [key, Json(entry['info']), entry['fetched'], entry['expires']]
+        if exists:
+            data.db_update(
+                self.bot, 'media_metadata',
+                set_arg='(key, info, fetched, expires) = (%s, %s, %s, %s)',
+                where_arg='key=%s', input_args=input_args + [key])
+        else:
+            data.db_insert(self.bot, 'media_metadata', input_args=input_args, mark=False)
+        self._remember(key, entry)
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.memory_limit:
+            self.entries.popitem(last=False)
+
+
+class AudioCache():
+    """Audio files kept on disk within a byte budget, evicted least recently used first.
+
+    Plugins register pin functions that return the names (usually URLs) of files that
+    should not be evicted, like the tracks of active playlists. Pins are only gathered
+    when the cache is over its budget.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.directory = '{}/media_cache'.format(bot.path)
+        self.size_limit = configurations.get(bot, __name__, key='cache_size_limit') * 1000000
+        self.files = OrderedDict()  # File name: size, least recently used first
+        self.total_size = 0
+        self.pending = {}  # Name: download future
+        self.pin_functions = {}  # Plugin name: function that returns pinned names
+        self.hits = 0
+        self.misses = 0
+        self.bytes_served = 0
+        self.evictions = 0
+        os.makedirs(self.directory, exist_ok=True)
+        for entry in sorted(os.scandir(self.directory), key=lambda it: it.stat().st_mtime):
+            self.files[entry.name] = entry.stat().st_size
+            self.total_size += entry.stat().st_size
+
+    def get(self, name):
+        """Gets the file location of the given name, or None if it is not cached."""
+        file_name = _get_file_name(name)
+        if file_name not in self.files:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.bytes_served += self.files[file_name]
+        self.files.move_to_end(file_name)
+        file_location = '{}/{}'.format(self.directory, file_name)
+        os.utime(file_location)  # Keeps the order across restarts
+        return file_location
+
+    def has(self, name):
+        """Checks for the file without counting it as a use."""
+        return _get_file_name(name) in self.files
+
+    def owns(self, file_location):
+        """Checks if the file is kept by the cache, rather than being too large for it."""
+        return os.path.dirname(os.path.abspath(file_location)) == os.path.abspath(self.directory)
+
+    async def add(self, url, name=None, file_location=None):
+        """Downloads the URL (or moves the given file) into the cache.
+
+        Returns the final file location. Files that are more than half of the cache size
+        limit are not kept in the cache, and the temporary location is returned instead.
+        The caller owns those files, and should remove them once they are not needed.
+        """
+        name = name or url
+        if name in self.pending:
+            return await asyncio.shield(self.pending[name])
+        future = asyncio.ensure_future(self._add(url, name, file_location))
+        self.pending[name] = future
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if self.pending.get(name) is future:
+                del self.pending[name]
+
+    async def _add(self, url, name, file_location):
+        if not file_location:
+            file_location, _ = await utilities.download_url(self.bot, url, include_name=True)
+        file_size = os.path.getsize(file_location)
+        if file_size > self.size_limit / 2:
+            logger.debug("Not caching %s (%s bytes)", name, file_size)
+            return file_location
+        file_name = _get_file_name(name)
+        cached_location = '{}/{}'.format(self.directory, file_name)
+        await utilities.future(shutil.move, file_location, cached_location)
+        self.total_size += file_size - self.files.pop(file_name, 0)
+        self.files[file_name] = file_size
+        self._evict(keep=file_name)
+        return cached_location
+
+    def _evict(self, keep=None):
+        """Removes unpinned files (other than keep) until the cache is within its budget."""
+        if self.total_size <= self.size_limit:
+            return
+        pinned = set()
+        for plugin_name, pin_function in self.pin_functions.items():
+            try:
+                pinned.update(_get_file_name(it) for it in pin_function(self.bot))
+            except Exception as e:
+                logger.warn("Failed to get pinned files from %s: %s", plugin_name, e)
+        for file_name in list(self.files):
+            if self.total_size <= self.size_limit:
+                break
+            if file_name in pinned or file_name == keep:
+                continue
+            try:
+                os.remove('{}/{}'.format(self.directory, file_name))
+            except OSError as e:
+                logger.warn("Failed to remove cached file %s: %s", file_name, e)
+            self.total_size -= self.files.pop(file_name)
+            self.evictions += 1
+        if self.total_size > self.size_limit:
+            logger.warn("Audio cache is over its limit with %s pinned files.", len(pinned))
+
+
+@plugins.command_spawner
+def get_commands(bot):
+    return [Command(
+        'mediacache', subcommands=[
+            SubCommand(doc='Shows audio and metadata cache statistics.', function=cache_stats)],
+        elevated_level=3, hidden=True, category='tools')]
+
+
+async def cache_stats(bot, context):
+    audio_cache, metadata_cache = _get_audio_cache(bot), _get_cache(bot)
+    audio_uses = audio_cache.hits + audio_cache.misses
+    metadata_uses = metadata_cache.hits + metadata_cache.misses
+    return Response(content=(
+        "Audio cache: {} files, {:.2f}/{:.2f} MB\n"
+        "Hit ratio: {:.2%} ({} hits, {} misses)\n"
+        "Served: {:.2f} MB, evicted {} files\n\n"
+        "Metadata cache: {} entries in memory\n"
+        "Hit ratio: {:.2%} ({} hits, {} misses)").format(
+            len(audio_cache.files), audio_cache.total_size / 1000000,
+            audio_cache.size_limit / 1000000,
+            audio_cache.hits / audio_uses if audio_uses else 0,
+            audio_cache.hits, audio_cache.misses,
+            audio_cache.bytes_served / 1000000, audio_cache.evictions,
+            len(metadata_cache.entries),
+            metadata_cache.hits / metadata_uses if metadata_uses else 0,
+            metadata_cache.hits, metadata_cache.misses))
+
+
+@plugins.db_template_spawner
+def get_templates(bot):
+    return {
+        'media_metadata_template': (
+            "key                text PRIMARY KEY,"  # Normalized URL or search query
+            "info               json,"
+            "fetched            bigint,"
+            "expires            bigint")
+    }
+
+
+@plugins.on_load
+def create_metadata_table(bot):
+    data.db_create_table(bot, 'media_metadata', template='media_metadata_template')
+    data.db_dump_exclude(bot, 'media_metadata')
+    metadata_index = 'IX_media_metadata_order'
+    if not data.db_exists(bot, metadata_index):
+        data.db_execute(
+            bot, 'CREATE INDEX {} ON media_metadata (fetched ASC)'.format(metadata_index))
+    metadata_ttl = configurations.get(bot, __name__, key='metadata_ttl')
+    data.db_delete(
+        bot, 'media_metadata', where_arg='fetched < %s',
+        input_args=[int(time.time()) - metadata_ttl])
+
+
+def get_key(query):
+    """Normalizes the URL or ytsearch: query so that equivalent lookups share an entry."""
+    query = query.strip()
+    if query.lower().startswith('ytsearch:'):
+        return 'ytsearch:' + ' '.join(query[9:].lower().split())
+    parsed = urlparse(query)
+    netloc = parsed.netloc.lower()
+    for prefix in ('www.', 'm.', 'music.'):
+        if netloc.startswith(prefix):
+            netloc = netloc[len(prefix):]
+    path = parsed.path.rstrip('/')
+    arguments = parse_qs(parsed.query)
+    if netloc == 'youtu.be' and path:
+        netloc, arguments, path = 'youtube.com', {'v': [path[1:]]}, '/watch'
+    if netloc == 'youtube.com' and path == '/watch':
+        arguments = {'v': arguments.get('v', [''])[:1]}
+    else:
+        arguments = {
+            key: value for key, value in arguments.items() if not key.startswith('utm_')}
+    return '{}{}{}'.format(
+        netloc, path, '?' + urlencode(sorted(arguments.items()), doseq=True) if arguments else '')
+
+
+def _compact_info(info):
+    compact = {key: info[key] for key in INFO_KEYS if info.get(key) is not None}
+    if info.get('formats'):
+        compact['formats'] = [
+            {key: it[key] for key in FORMAT_KEYS if it.get(key) is not None}
+            for it in info['formats']]
+    compact.setdefault('webpage_url', info.get('url'))
+    return compact
+
+
+def _get_file_name(name):
+    return hashlib.sha1(name.encode('utf8')).hexdigest()
+
+
+def _get_audio_cache(bot):
+    audio_cache = data.get(bot, __name__, 'audio_cache', volatile=True)
+    if audio_cache is None:
+        audio_cache = AudioCache(bot)
+        data.add(bot, __name__, 'audio_cache', audio_cache, volatile=True)
+    return audio_cache
+
+
+def _get_cache(bot):
+    metadata_cache = data.get(bot, __name__, 'metadata_cache', volatile=True)
+    if metadata_cache is None:
+        metadata_cache = MetadataCache(bot)
+        data.add(bot, __name__, 'metadata_cache', metadata_cache, volatile=True)
+    return metadata_cache
+
+
+async def extract_info(bot, query, streams=False):
+    """Gets the information of the given URL or ytsearch: query.
+
+    Search queries return the first result. The returned dictionary only has a subset
+    of the youtube_dl information (see INFO_KEYS and FORMAT_KEYS).
+
+    Keyword arguments:
+    streams -- Ensures that the stream URLs have not expired.
+    """
+    return await _get_cache(bot).get(query, streams=streams)
+
+
+def add_info(bot, info, query=None):
+    """Adds information that was extracted elsewhere, like playlist entries."""
+    return _get_cache(bot).add(info, query=query)
+
+
+def get_audio(bot, name):
+    """Gets the location of the cached audio file, or None if it is not cached."""
+    return _get_audio_cache(bot).get(name)
+
+
+def has_audio(bot, name):
+    """Checks if the audio file is cached without counting it as a hit or miss."""
+    return _get_audio_cache(bot).has(name)
+
+
+async def add_audio(bot, url, name=None, file_location=None):
+    """Downloads the URL into the audio cache and returns the file location.
+
+    Files too large for the cache are not kept, and belong to the caller instead (see
+    owns_file).
+
+    Keyword arguments:
+    name -- Stores the file under this name instead of the URL.
+    file_location -- Moves this file into the cache instead of downloading the URL.
+    """
+    return await _get_audio_cache(bot).add(url, name=name, file_location=file_location)
+
+
+def owns_file(bot, file_location):
+    """Checks if the file is kept by the audio cache.
+
+    Files returned by add_audio or download_audio that are not kept by the cache should
+    be removed by the caller once they are no longer used.
+    """
+    return _get_audio_cache(bot).owns(file_location)
+
+
+async def download_audio(bot, url):
+    """Downloads the best audio of the given youtube_dl URL into the audio cache."""
+    info = await extract_info(bot, url, streams=True)
+    stream_format = info if info.get('url') else info['formats'][0]
+    return await add_audio(bot, stream_format['url'], name=url)
+
+
+def register_pins(bot, plugin_name, function):
+    """Registers a function that returns the names of files that should not be evicted.
+
+    The function is given the bot, and is only called when the cache is over its limit.
+    """
+    _get_audio_cache(bot).pin_functions[plugin_name] = function
+
+
+async def probe_duration(bot, url, extension=None, limit=None, headers=None):
+    """Gets the duration of the audio at the given URL without downloading all of it.
+
+    The start and end of the file are fetched with range requests first, and more of the
+    file is only fetched if the duration is still unknown. Servers that do not support
+    range requests are streamed from the start instead.
+
+    Keyword arguments:
+    extension -- File extension, which TinyTag uses to pick the parser.
+    limit -- Stops early once the streamed audio is longer than this many seconds.
+        The returned duration is then only a lower bound.
+    headers -- Extra HTTP headers for the request (like youtube_dl http_headers).
+    """
+    probe_limit = configurations.get(bot, __name__, key='probe_limit')
+    suffix = '.' + extension if extension else ''
+    timeout = aiohttp.ClientTimeout(total=PROBE_TIMEOUT)
+    try:
+        with tempfile.NamedTemporaryFile(suffix=suffix) as probe_file:
+            async with aiohttp.ClientSession(headers=headers, timeout=timeout) as session:
+                return await _probe(session, url, probe_file, probe_limit, limit)
+    except BotException as e:
+        raise e  # Pass up
+    except Exception as e:
+        raise CBException("Failed to probe the duration of the URL.", url, e=e)
+
+
+async def _probe(session, url, probe_file, probe_limit, limit):
+    async with session.get(url, headers={'Range': 'bytes=0-{}'.format(PROBE_CHUNK - 1)}) as r:
+        if r.status == 200:  # Range requests are not supported
+            return await _probe_stream(r, probe_file, probe_limit, limit)
+        elif r.status != 206:
+            raise CBException("Failed to probe the URL (HTTP {}).".format(r.status))
+        head = await r.read()
+        total_size = r.headers.get('Content-Range', '').rpartition('/')[2]
+        total_size = int(total_size) if total_size.isdigit() else len(head)
+
+    # Keep the file sparse so that TinyTag sees the real file size
+    probe_file.truncate(total_size)
+    probe_file.write(head[:total_size])
+    probe_file.flush()
+    head_end, tail_start = len(head), total_size
+    chunk_size, fetch_tail = PROBE_CHUNK, True
+    while True:
+        duration = await utilities.future(_read_duration, probe_file.name)
+        if duration:
+            return duration
+        remaining = tail_start - head_end
+        if remaining <= 0:
+            raise CBException("Failed to read the duration of the file.")
+        elif total_size - remaining >= probe_limit:
+            raise CBException("Failed to read the duration within the probe limit.")
+
+        # Alternate between the end and the start, since some formats keep the index last
+        size = min(chunk_size, remaining)
+        if fetch_tail:
+            tail_start -= size
+            await _fetch_range(session, url, probe_file, tail_start, tail_start + size)
+        else:
+            await _fetch_range(session, url, probe_file, head_end, head_end + size)
+            head_end += size
+        chunk_size *= 2
+        fetch_tail = not fetch_tail
+
+
+async def _probe_stream(response, probe_file, probe_limit, limit):
+    total_size = response.content_length
+    if total_size:
+        probe_file.truncate(total_size)
+    received, check_at = 0, PROBE_CHUNK
+    async for chunk in response.content.iter_chunked(PROBE_CHUNK):
+        probe_file.seek(received)
+        probe_file.write(chunk)
+        received += len(chunk)
+        if received < check_at:
+            continue
+        check_at *= 2
+        probe_file.flush()
+        duration = await utilities.future(_read_duration, probe_file.name)
+        if duration and (total_size or (limit and duration > limit)):
+            return duration  # A lower bound if the total size is unknown
+        elif received >= probe_limit:
+            raise CBException("Failed to read the duration within the probe limit.")
+    probe_file.flush()
+    duration = await utilities.future(_read_duration, probe_file.name)
+    if not duration:
+        raise CBException("Failed to read the duration of the file.")
+    return duration
+
+
+async def _fetch_range(session, url, probe_file, start, end):
+    async with session.get(url, headers={'Range': 'bytes={}-{}'.format(start, end - 1)}) as r:
+        if r.status != 206:
+            raise CBException("Failed to probe the URL (HTTP {}).".format(r.status))
+        probe_file.seek(start)
+        probe_file.write((await r.read())[:end - start])
+    probe_file.flush()
+
+
+def _read_duration(file_location):
+    try:
+        return TinyTag.get(file_location).duration
+    except Exception:  # Not enough of the file is available yet
+        return None
@@ -0,0 +1,668 @@
+"""Offline benchmarks of the music player.
+
+Drives MusicPlayer with fake guilds, channels, messages, and voice clients, an
+in-memory stand-in for the playlist tables, and a fake media cache where every
+track is already cached. No network, database, or ffmpeg is used, so this runs on
+any machine with the bot's own requirements installed (JshBot, discord.py, and the
+playlist requirements).
+
+Scenarios (each run at every playlist size unless noted):
+render -- Rebuilds and "edits" the interface, cycling through the pages.
+render_cold -- Same as render, but with the rendered explorer pages invalidated.
+storm -- Bursts of interface refresh requests, until the render loop settles.
+skip_storm -- Bursts of skips, until the single resulting transition finishes.
+shuffle -- Shuffled track transitions (as if each track ended).
+swap -- Swaps two random tracks with the swap command.
+move -- Moves a random track with the move command.
+import -- Imports a tracklist of 100 tracks (size independent).
+
+Usage: python bench_playlist.py [--sizes 5 100 500] [--rounds 200] [--json]
+"""
+import importlib.util
+import itertools
+import argparse
+import tempfile
+import logging
+import asyncio
+import random
+import json
+import time
+import sys
+import os
+
+import yaml
+import discord
+
+from collections import namedtuple
+
+PLUGIN_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PLUGIN_DIRECTORY, 'plugin_data'))
+
+from jshbot import configurations, data, utilities
+
+# Rendering and navigation delays are shortened so that storms settle quickly
+RENDER_DELAY = 0.005
+RENDER_WINDOW = 0.01
+NAVIGATION_DELAY = 0.01
+STORM_SIZE = 50  # Refresh requests per storm
+SKIP_STORM_SIZE = 10  # Skips per skip storm
+IMPORT_SIZE = 100  # Tracks per import (the import command limit)
+FRAME = b'\x00' * 3840  # 20 ms of silent 48 kHz stereo PCM
+
+_ids = itertools.count(1 << 32)
+
+
+def _get_id():
+    return next(_ids) << 22  # Spread like real snowflakes for the progress phase
+
+
+class MemoryDatabase():
+    """Runs the playlist table queries of the playlist plugin in memory.
+
+    Only the statement shapes used by the plugin are supported.
+    """
+
+    def __init__(self):
+        self.tables = {}  # Table name: list of row dictionaries
+        self.columns = {}  # Table name: column names
+        self.ids = itertools.count(1)
+
+    @staticmethod
+    def _get_name(table, table_suffix):
+        return table if table_suffix is None else '{}_{}'.format(table, table_suffix)
+
+    @staticmethod
+    def _get_value(value):
+        return getattr(value, 'adapted', value)  # Unwrap psycopg2 Json
+
+    @staticmethod
+    def _get_cursor(rows):
+        return type('Cursor', (), {
+            'rowcount': len(rows), 'fetchall': lambda self: rows,
+            'fetchone': lambda self: rows[0] if rows else None})()
+
+    @staticmethod
+    def _match(where_arg, input_args):
+        """Builds a row filter from "column=%s AND ..." clauses."""
+        if not where_arg:
+            return lambda row: True
+        columns = [it.split('=')[0].strip() for it in where_arg.split(' AND ')]
+        values = dict(zip(columns, input_args))
+        return lambda row: all(row[key] == value for key, value in values.items())
+
+    def _insert(self, name, columns, values):
+        row = dict.fromkeys(self.columns[name])
+        row.update(zip(columns, (self._get_value(it) for it in values)))
+        row['id'] = next(self.ids)
+        self.tables[name].append(row)
+        return row
+
+    def db_exists(self, bot, table, table_suffix=None):
+        return self._get_name(table, table_suffix) in self.tables
+
+    def db_create_table(self, bot, table, table_suffix=None, template=None):
+        name = self._get_name(table, table_suffix)
+        template = bot.templates[template]
+        self.tables.setdefault(name, [])
+        self.columns[name] = [it.split()[0] for it in template.split(',') if it.strip()]
+
+    def db_drop_table(self, bot, table, table_suffix=None, safe=False):
+        name = self._get_name(table, table_suffix)
+        self.tables.pop(name, None)
+        self.columns.pop(name, None)
+
+    def db_dump_exclude(self, bot, table):
+        pass
+
+    def db_select(
+            self, bot, select_arg='*', from_arg=None, where_arg=None, additional=None,
+            limit=None, input_args=None, table_suffix=None, safe=True):
+        name = self._get_name(from_arg, table_suffix)
+        if name not in self.tables:
+            return None
+        rows = list(filter(self._match(where_arg, input_args), self.tables[name]))
+        if additional and additional.startswith('ORDER BY'):
+            rows.sort(key=lambda it: (it['position'], it['id']))
+        columns = [it.strip() for it in select_arg.split(',')]
+        row_type = namedtuple('Row', columns)
+        return self._get_cursor([row_type(*(it[column] for column in columns)) for it in rows])
+
+    def db_update(
+            self, bot, table, table_suffix=None, set_arg=None, where_arg=None,
+            input_args=None, safe=True):
+        name = self._get_name(table, table_suffix)
+        set_columns = [it.split('=')[0].strip() for it in set_arg.split(',')]
+        values = [self._get_value(it) for it in input_args[:len(set_columns)]]
+        match = self._match(where_arg, input_args[len(set_columns):])
+        for row in self.tables[name]:
+            if match(row):
+                row.update(zip(set_columns, values))
+
+    def db_delete(self, bot, table, table_suffix=None, where_arg=None, input_args=None, safe=True):
+        name = self._get_name(table, table_suffix)
+        match = self._match(where_arg, input_args)
+        self.tables[name] = [it for it in self.tables.get(name, []) if not match(it)]
+
+    def db_execute(self, bot, execute, input_args=None, safe=True, pass_error=False, mark=True):
+        name = execute.split('"')[1] if '"' in execute else None
+        if execute.startswith('INSERT'):
+            columns = [it.strip() for it in execute.split('(')[1].split(')')[0].split(',')]
+            returning = [it.strip() for it in execute.split('RETURNING')[1].split(',')]
+            row_type = namedtuple('Row', returning)
+            rows = []
+            for index in range(0, len(input_args), len(columns)):
+                row = self._insert(name, columns, input_args[index:index + len(columns)])
+                rows.append(row_type(*(row[it] for it in returning)))
+            return self._get_cursor(rows)
+        elif 'FROM (VALUES' in execute:  # Renumbering
+            positions = dict(zip(input_args[::2], input_args[1::2]))
+            for row in self.tables[name]:
+                if row['id'] in positions:
+                    row['position'] = positions[row['id']]
+        return self._get_cursor([])  # Schema migrations are not needed here
+
+
+class MemoryStore():
+    """Stands in for the data.get/add/remove key-value storage."""
+
+    def __init__(self):
+        self.stores = {}
+
+    def _get_store(self, plugin_name, guild_id, channel_id, user_id, volatile):
+        return self.stores.setdefault(
+            (plugin_name, guild_id, channel_id, user_id, volatile), {})
+
+    def get(
+            self, bot, plugin_name, key, guild_id=None, channel_id=None, user_id=None,
+            default=None, create=False, volatile=False, save=False):
+        store = self._get_store(plugin_name, guild_id, channel_id, user_id, volatile)
+        if key not in store and create:
+            store[key] = default
+        return store.get(key, default)
+
+    def add(
+            self, bot, plugin_name, key, value, guild_id=None, channel_id=None,
+            user_id=None, volatile=False):
+        self._get_store(plugin_name, guild_id, channel_id, user_id, volatile)[key] = value
+
+    def remove(
+            self, bot, plugin_name, key, guild_id=None, channel_id=None, user_id=None,
+            default=None, safe=False, volatile=False):
+        store = self._get_store(plugin_name, guild_id, channel_id, user_id, volatile)
+        return store.pop(key, default)
+
+
+class FakeMediaCache():
+    """Media cache plugin stand-in where every track is already cached."""
+
+    def __init__(self, audio_file):
+        self.audio_file = audio_file
+
+    def get_audio(self, bot, name):
+        return self.audio_file
+
+    def has_audio(self, bot, name):
+        return True
+
+    def owns_file(self, bot, file_location):
+        return True
+
+    async def download_audio(self, bot, url):
+        return self.audio_file
+
+    async def extract_info(self, bot, query, streams=False):
+        await asyncio.sleep(0)
+        return _get_track_info(query)
+
+    def add_info(self, bot, info, query=None):
+        return info
+
+    async def probe_duration(self, bot, url, extension=None, limit=None, headers=None):
+        return 200
+
+    def register_pins(self, bot, plugin_name, function):
+        pass
+
+
+class SilentSource(discord.AudioSource):
+
+    def read(self):
+        return FRAME
+
+
+class FakeVoiceClient():
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.source = None
+        self.playing = False
+
+    def is_playing(self):
+        return self.playing
+
+    def is_paused(self):
+        return False
+
+    def play(self, source, after=None):
+        self.source, self.playing = source, True
+
+    def stop(self):
+        self.playing = False
+
+    def pause(self):
+        self.playing = False
+
+    def resume(self):
+        self.playing = True
+
+
+class FakeMember():
+
+    def __init__(self, guild, bot=False):
+        self.id = _get_id()
+        self.guild = guild
+        self.bot = bot
+        self.name = 'member{}'.format(self.id)
+        self.mention = '<@{}>'.format(self.id)
+        self.voice = type('VoiceState', (), {'channel': guild.voice_channel})()
+
+    def __str__(self):
+        return self.name
+
+    async def send(self, *args, **kwargs):
+        pass
+
+
+class FakeMessage():
+
+    def __init__(self, channel, author, content='', embed=None):
+        self.id = _get_id()
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.embed = embed
+        self.type = discord.MessageType.default
+        self.reactions, self.attachments, self.embeds = [], [], []
+
+    async def edit(self, content=None, embed=None):
+        self.channel.edits += 1
+        await asyncio.sleep(0)
+
+    async def delete(self):
+        pass
+
+    async def add_reaction(self, reaction):
+        pass
+
+    async def remove_reaction(self, reaction, member):
+        pass
+
+    async def clear_reactions(self):
+        pass
+
+
+class FakeTextChannel():
+
+    def __init__(self, guild):
+        self.id = _get_id()
+        self.guild = guild
+        self.mention = '<#{}>'.format(self.id)
+        self.edits = 0
+
+    async def send(self, content=None, embed=None, file=None):
+        return FakeMessage(self, self.guild.me, content or '', embed)
+
+
+class FakeGuild():
+
+    def __init__(self, listeners=3):
+        self.id = _get_id()
+        self.name = 'guild{}'.format(self.id)
+        self.afk_channel = None
+        self.voice_channel = type('VoiceChannel', (), {
+            'id': _get_id(), 'guild': self, 'members': []})()
+        self.text_channel = FakeTextChannel(self)
+        self.voice_client = FakeVoiceClient(self.voice_channel)
+        self.me = FakeMember(self, bot=True)
+        self.members = [FakeMember(self) for _ in range(listeners)]
+        self.voice_channel.members = self.members + [self.me]
+        self.channels = {it.id: it for it in (self.text_channel, self.voice_channel)}
+
+    def get_member(self, user_id):
+        return next((it for it in self.members if it.id == user_id), None)
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    async def query_members(self, query=None, limit=5, user_ids=None, cache=True):
+        return [it for it in self.members if it.id in (user_ids or [])]
+
+
+class FakeBot():
+
+    def __init__(self, plugin_directory):
+        self.path = plugin_directory
+        self.loop = asyncio.get_event_loop()
+        self.user = None
+        self.extra = None
+        self.plugins = {}
+        self.templates = {}
+        self.guilds = []
+
+    def get_guild(self, guild_id):
+        return next((it for it in self.guilds if it.id == guild_id), None)
+
+    def get_channel(self, channel_id):
+        for guild in self.guilds:
+            if channel_id in guild.channels:
+                return guild.channels[channel_id]
+
+    async def get_reaction_users(self, reaction):
+        return []
+
+    async def wait_for(self, event, check=None, timeout=None):
+        await asyncio.Future()
+
+
+class FakeContext():
+
+    def __init__(self, guild, arguments=None, options=None):
+        self.guild = guild
+        self.author = guild.members[0]
+        self.channel = guild.text_channel
+        self.message = FakeMessage(guild.text_channel, self.author)
+        self.arguments = arguments or []
+        self.options = options or {}
+
+
+def _get_track_info(url):
+    return {
+        'webpage_url': url,
+        'title': 'Track {}'.format(url.rsplit('=', 1)[-1]),
+        'duration': random.randint(60, 600),
+        'formats': [{'url': url + '&format=audio', 'ext': 'webm'}],
+        'thumbnail': 'https://example.com/thumbnail.png',
+        'view_count': random.randint(0, 1000000),
+        'uploader': 'Uploader',
+        'upload_date': '20200101'
+    }
+
+
+def _get_url(number):
+    return 'https://www.youtube.com/watch?v={:011d}'.format(number)
+
+
+def _load_playlist(bot):
+    """Loads the plugin with the in-memory stand-ins patched into JshBot."""
+    database, store = MemoryDatabase(), MemoryStore()
+    for name in (
+            'db_exists', 'db_create_table', 'db_drop_table', 'db_dump_exclude',
+            'db_select', 'db_update', 'db_delete', 'db_execute'):
+        setattr(data, name, getattr(database, name))
+    for name in ('get', 'add', 'remove'):
+        setattr(data, name, getattr(store, name))
+    data.is_mod = lambda *args, **kwargs: True
+    data.has_custom_role = lambda *args, **kwargs: True
+    data.get_custom_role = lambda *args, **kwargs: None
+    data.get_channel = lambda bot, channel_id, **kwargs: bot.get_channel(channel_id)
+
+    with open(os.path.join(PLUGIN_DIRECTORY, 'playlist-config.yaml')) as config_file:
+        config = yaml.safe_load(config_file)
+    config.update({  # Keep ffmpeg and the network out of the way
+        'stream_while_caching': False, 'opus_playback': False,
+        'loudness_normalization': False, 'audio_node': False,
+        'max_total_track_limit': 0, 'max_user_track_limit': 0})
+    configurations.get = (
+        lambda bot, plugin_name, key=None, **kwargs: config[key] if key else config)
+
+    async def _join_and_ready(bot, voice_channel, **kwargs):
+        return voice_channel.guild.voice_client
+
+    async def _stop_audio(bot, guild, **kwargs):
+        guild.voice_client.stop()
+
+    async def _upload_to_discord(bot, fp, filename=None, **kwargs):
+        return 'https://example.com/{}'.format(filename)
+
+    utilities.join_and_ready = _join_and_ready
+    utilities.stop_audio = _stop_audio
+    utilities.upload_to_discord = _upload_to_discord
+
+    spec = importlib.util.spec_from_file_location(
+        'playlist.py', os.path.join(PLUGIN_DIRECTORY, 'playlist.py'))
+    playlist = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(playlist)
+    bot.templates.update(playlist.get_templates(bot))
+    playlist.RENDER_DELAY = RENDER_DELAY
+    playlist.RENDER_WINDOW = RENDER_WINDOW
+    playlist.NAVIGATION_DELAY = NAVIGATION_DELAY
+    bot.plugins['playlist.py'] = playlist
+    return playlist
+
+
+async def _create_guild(bot, playlist, size, shuffle=False):
+    """Creates a guild with the given number of tracks."""
+    guild = FakeGuild()
+    bot.guilds.append(guild)
+    data.add(bot, playlist.__name__, 'channel', guild.text_channel.id, guild_id=guild.id)
+    data.add(bot, playlist.__name__, 'mode', playlist.Modes.PLAYLIST, guild_id=guild.id)
+    data.add(bot, playlist.__name__, 'shuffle', shuffle, guild_id=guild.id)
+    entries = []
+    for number in range(size):
+        url = _get_url(number)
+        entries.append(await playlist._get_track_entry(
+            bot, url, _get_track_info(url), user_id=random.choice(guild.members).id))
+    if entries:
+        playlist._insert_tracks(bot, guild, entries)
+    return guild
+
+
+async def _start_player(bot, playlist, guild):
+    """Starts a player and waits until it plays the first track."""
+    message = FakeMessage(guild.text_channel, guild.members[0])
+    player = playlist.MusicPlayer(bot, message)
+    player._get_audio_source = lambda offset=0: SilentSource()
+    data.add(bot, playlist.__name__, 'music_player', player, guild_id=guild.id, volatile=True)
+    while player.state == playlist.States.LOADING or player.loading_interface:
+        await asyncio.sleep(0.05)
+    await player.play(track_index=0)
+    return player
+
+
+async def _settle(player):
+    """Waits until the render loop and play transitions have nothing left to do."""
+    while player.dirty or player.render_event.is_set() or player.play_task:
+        await asyncio.sleep(0.001)
+
+
+def _get_result(scenario, size, latencies, elapsed=None, **extra):
+    latencies = sorted(latencies)
+    elapsed = sum(latencies) if elapsed is None else elapsed
+    return {
+        'scenario': scenario,
+        'tracks': size,
+        'operations': len(latencies),
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed else 0,
+        'latency_ms': {
+            'mean': 1000 * sum(latencies) / len(latencies),
+            'p50': 1000 * latencies[len(latencies) // 2],
+            'p90': 1000 * latencies[int(len(latencies) * 0.9)],
+            'max': 1000 * latencies[-1]
+        },
+        'extra': extra
+    }
+
+
+async def bench_render(bot, playlist, player, size, rounds, cold=False):
+    interface_flags = set(playlist.INTERFACE_FLAGS)
+    guild_tracklist = player.guild_tracklist
+    latencies = []
+    for number in range(rounds):
+        player.page = number % guild_tracklist.total_pages
+        if cold:
+            guild_tracklist.pages.clear()
+        start = time.perf_counter()
+        await player._render(set(interface_flags))
+        latencies.append(time.perf_counter() - start)
+    return _get_result('render_cold' if cold else 'render', size, latencies)
+
+
+async def bench_storm(bot, playlist, player, size, rounds):
+    flags = list(playlist.INTERFACE_FLAGS) + ['satellite']
+    latencies = []
+    edits = player.guild.text_channel.edits
+    for _ in range(max(rounds // 10, 1)):
+        start = time.perf_counter()
+        for number in range(STORM_SIZE):
+            if number % 10 == 0:
+                asyncio.ensure_future(player.update_interface(notification_text=str(number)))
+            else:
+                player.request_render(random.choice(flags))
+            await asyncio.sleep(0)
+        await _settle(player)
+        latencies.append(time.perf_counter() - start)
+    storms = len(latencies)
+    return _get_result(
+        'storm', size, latencies, requests=storms * STORM_SIZE,
+        edits=player.guild.text_channel.edits - edits)
+
+
+async def bench_skip_storm(bot, playlist, player, size, rounds):
+    member = player.guild.members[0]
+    plays = 0
+    original_play = player.play
+
+    async def _play(**kwargs):
+        nonlocal plays
+        plays += 1
+        return await original_play(**kwargs)
+
+    player.play = _play
+    latencies = []
+    for _ in range(max(rounds // 10, 1)):
+        start = time.perf_counter()
+        for _ in range(SKIP_STORM_SIZE):
+            await player.track_navigate(True, member)
+        await _settle(player)
+        latencies.append(time.perf_counter() - start)
+    del player.play
+    return _get_result(
+        'skip_storm', size, latencies, skips=len(latencies) * SKIP_STORM_SIZE, plays=plays)
+
+
+async def bench_shuffle(bot, playlist, size, rounds):
+    guild = await _create_guild(bot, playlist, size, shuffle=True)
+    player = await _start_player(bot, playlist, guild)
+    latencies = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        player.request_play(skips=1)
+        await player.play_task
+        latencies.append(time.perf_counter() - start)
+    await _settle(player)
+    await player.stop()
+    return _get_result('shuffle', size, latencies)
+
+
+async def bench_swap(bot, playlist, player, size, rounds):
+    latencies = []
+    for _ in range(rounds):
+        context = FakeContext(player.guild, arguments=random.sample(range(1, size + 1), 2))
+        start = time.perf_counter()
+        await playlist.swap_tracks(bot, context)
+        latencies.append(time.perf_counter() - start)
+    await _settle(player)
+    return _get_result('swap', size, latencies)
+
+
+async def bench_move(bot, playlist, player, size, rounds):
+    latencies = []
+    for _ in range(rounds):
+        context = FakeContext(player.guild, arguments=random.sample(range(1, size + 1), 2))
+        start = time.perf_counter()
+        await playlist.move_track(bot, context)
+        latencies.append(time.perf_counter() - start)
+    await _settle(player)
+    return _get_result('move', size, latencies)
+
+
+async def bench_import(bot, playlist, rounds):
+    guild = await _create_guild(bot, playlist, 0)
+    tracklist_data = [_get_url(it) for it in range(IMPORT_SIZE)]
+    latencies = []
+    for _ in range(max(rounds // 20, 1)):
+        context = FakeContext(guild)
+        response = type('Response', (), {
+            'extra': (list(tracklist_data), False), 'message': context.message})()
+        start = time.perf_counter()
+        await playlist._import_tracklist_status(bot, context, response)
+        latencies.append(time.perf_counter() - start)
+        data.db_drop_table(bot, 'playlist', table_suffix=guild.id)
+        playlist._get_guild_tracklist(bot, guild).clear()
+    return _get_result(
+        'import', IMPORT_SIZE, latencies,
+        tracks_per_second=IMPORT_SIZE * len(latencies) / sum(latencies))
+
+
+async def run_benchmarks(sizes, rounds):
+    with tempfile.NamedTemporaryFile(suffix='.webm') as audio_file:
+        audio_file.write(FRAME * 50)
+        audio_file.flush()
+        bot = FakeBot(PLUGIN_DIRECTORY)
+        playlist = _load_playlist(bot)
+        bot.plugins['media_cache.py'] = FakeMediaCache(audio_file.name)
+
+        results = []
+        for size in sizes:
+            guild = await _create_guild(bot, playlist, size)
+            player = await _start_player(bot, playlist, guild)
+            results.append(await bench_render(bot, playlist, player, size, rounds))
+            results.append(await bench_render(bot, playlist, player, size, rounds, cold=True))
+            results.append(await bench_storm(bot, playlist, player, size, rounds))
+            results.append(await bench_skip_storm(bot, playlist, player, size, rounds))
+            if size > 1:
+                results.append(await bench_swap(bot, playlist, player, size, rounds))
+                results.append(await bench_move(bot, playlist, player, size, rounds))
+            await player.stop()
+            results.append(await bench_shuffle(bot, playlist, size, rounds))
+        results.append(await bench_import(bot, playlist, rounds))
+        return results
+
+
+def print_results(results):
+    print('{:<12} {:>6} {:>6} {:>10} {:>9} {:>9} {:>9}  {}'.format(
+        'scenario', 'tracks', 'ops', 'ops/s', 'mean ms', 'p90 ms', 'max ms', 'notes'))
+    for result in results:
+        latency = result['latency_ms']
+        print('{:<12} {:>6} {:>6} {:>10.1f} {:>9.3f} {:>9.3f} {:>9.3f}  {}'.format(
+            result['scenario'], result['tracks'], result['operations'], result['throughput'],
+            latency['mean'], latency['p90'], latency['max'],
+            ', '.join('{}={:g}'.format(*it) for it in result['extra'].items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline music player benchmarks.')
+    parser.add_argument(
+        '--sizes', type=int, nargs='+', default=[5, 100, 500], help='Playlist sizes.')
+    parser.add_argument(
+        '--rounds', type=int, default=200, help='Operations per scenario and size.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    parser.add_argument('--json', action='store_true', help='Prints the results as JSON.')
+    parser.add_argument('--verbose', action='store_true', help='Shows plugin log output.')
+    arguments = parser.parse_args()
+
+    random.seed(arguments.seed)
+    if not arguments.verbose:
+        logging.disable(logging.WARNING)
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(run_benchmarks(arguments.sizes, arguments.rounds))
+    if arguments.json:
+        print(json.dumps(results, indent=4))
+    else:
+        print_results(results)
+
+
+if __name__ == '__main__':
+    main()
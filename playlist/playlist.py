@@ -1,19 +1,29 @@
+import subprocess
+import threading
+import itertools
+import tempfile
+import aiohttp
 import random
+import bisect
+import heapq
 import asyncio
+import json
 import time
 import math
+import os
 
 import yaml
 import discord
+import audio_node
 
 from urllib.parse import urlparse
-from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, Counter, deque, namedtuple
 from psycopg2.extras import Json
 from datetime import datetime
 
 from enum import Enum, IntEnum
 from youtube_dl import YoutubeDL
-from tinytag import TinyTag
 
 from jshbot import utilities, configurations, data, plugins, logger
 from jshbot.exceptions import ConfiguredBotException, BotException
@@ -27,6 +37,30 @@ uses_configuration = True
 TITLE_LIMIT = 50  # Track title character limit in the track explorer
 URL_LIMIT = 140  # Track URL limit to be displayed in the track explorer
 MIRROR_TIMER = 60  # Chat mirror timer in seconds
+PREFETCH_COUNT = 2  # Number of upcoming tracks to download ahead of time
+RENDER_DELAY = 0.5  # Seconds to collect interface refresh requests before rendering
+RENDER_WINDOW = 1  # Minimum seconds between edits of the same player message
+INTERFACE_FLAGS = ('title', 'info', 'footer', 'notification')
+PAGE_SIZE = 5  # Tracks per page in the track explorer
+TRACK_COLUMNS = ('url', 'downloadurl', 'title', 'duration', 'userid', 'timestamp', 'extra')
+TRACK_SELECT = 'id, url, downloadurl, title, duration, userid, timestamp, position'  # No extra
+EXTRA_CACHE_SIZE = 2  # Extra data of the current and next track
+STREAM_CHUNK = 64 * 1024  # Bytes read from the remote stream at a time
+STREAM_TIMEOUT = 10  # Seconds to wait for the stream to start before downloading instead
+OPUS_SUFFIX = '#opus'  # Audio cache name suffix of Opus transcodes
+OPUS_BITRATE = 128
+MAX_GAIN = 12  # Loudness normalization gain limit in decibels
+SHUFFLE_HISTORY = 50  # Number of shuffled tracks that can be navigated back to
+NAVIGATION_DELAY = 0.4  # Seconds to wait for more navigation before changing tracks
+PROGRESS_INTERVAL = 5  # Seconds between progress bar refreshes of a playing player
+CHECKPOINT_INTERVAL = 30  # Seconds between checkpoints of a playing player
+CHECKPOINT_EXPIRY = 3600  # Checkpoints older than this are not restored after a restart
+MEMBER_QUERY_LIMIT = 100  # Maximum user IDs per gateway member query
+IMPORT_LIMIT = 100  # Maximum tracks per import
+TIME_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # Seconds
+SIZE_BUCKETS = tuple(1000000 * 2 ** it for it in range(8))  # Bytes (1 MB to 128 MB)
+
+Track = namedtuple('Track', TRACK_SELECT.split(', '))  # Checkpointed queue tracks
 
 class States(IntEnum):
     PLAYING, PAUSED, STOPPED, LOADING = range(4)
@@ -72,6 +106,9 @@ def get_commands(bot):
                 function=get_info),
             SubCommand(
                 Opt('add'),
+                Opt('at', attached='position', optional=True,
+                    convert=int, quotes_recommended=False,
+                    doc='Inserts the track at the given position instead of the end.'),
                 Arg('query', argtype=ArgTypes.MERGED),
                 doc='Adds a song to the playlist. Can either be a URL to a supported site '
                     '(YouTube, Bandcamp, SoundCloud, etc.) or a YouTube search query',
@@ -135,6 +172,11 @@ def get_commands(bot):
                 Arg('track 1', convert=int, quotes_recommended=False),
                 Arg('track 2', convert=int, quotes_recommended=False),
                 doc='Swaps the position of the given tracks.', function=swap_tracks),
+            SubCommand(
+                Opt('move'),
+                Arg('track number', convert=int, quotes_recommended=False),
+                Arg('new position', convert=int, quotes_recommended=False),
+                doc='Moves the given track to the new position.', function=move_track),
             SubCommand(
                 Opt('control'),
                 Opt('pause', optional=True, group='action'),
@@ -173,6 +215,17 @@ def get_commands(bot):
         allow_direct=False, category='music',
         pre_check=check_whitelist, description='Play music.'))
 
+    new_commands.append(Command(
+        'playlistmetrics', subcommands=[
+            SubCommand(
+                Opt('json', optional=True, doc='Uploads the metrics as a JSON file.'),
+                Opt('guild', attached='guild ID', optional=True,
+                    quotes_recommended=False, convert=int,
+                    doc='Shows the metrics of the player in this guild only.'),
+                doc='Shows playback latency, cache, and interface metrics of music players.',
+                function=player_metrics)],
+        elevated_level=3, hidden=True, category='music'))
+
     return new_commands
 
 
@@ -187,23 +240,636 @@ def get_templates(bot):
             "userid             bigint,"
             "timestamp          bigint,"
             "extra              json,"
-            "id                 serial UNIQUE"
+            "id                 serial UNIQUE,"
+            "position           double precision"  # Sort key (see GuildTracklist)
         )
     }
 
 
+class ShuffleSchedule():
+    """Shuffled play order of track IDs, drawn one cycle at a time.
+
+    Each cycle is a Fisher-Yates permutation of the tracklist, so every track plays once
+    before any track repeats. Added tracks are swapped into a random upcoming position,
+    and removed tracks are replaced by the last upcoming track. This keeps the remaining
+    order uniformly random without reshuffling, and keeps the next track unchanged
+    unless it is the one removed.
+    """
+
+    def __init__(self, track_ids=()):
+        self.track_ids = set(track_ids)
+        self.order = []  # Current cycle, with played tracks before start
+        self.positions = {}  # Track ID: index in order (upcoming tracks only)
+        self.start = 0  # Index of the next track in order
+
+    def peek(self, count=1, last_id=None):
+        """Gets the IDs of the next tracks in the cycle, starting a new cycle if needed.
+
+        Keyword arguments:
+        last_id -- Track that should not start the new cycle (the current track).
+        """
+        if self.start >= len(self.order):
+            self._new_cycle(last_id)
+        return self.order[self.start:self.start + count]
+
+    def mark_played(self, track_id):
+        """Takes the track out of the rest of the cycle."""
+        index = self.positions.pop(track_id, None)
+        if index is None:
+            return
+        if index != self.start:  # Played out of order
+            self._move(self.order[self.start], index)
+            self.order[self.start] = track_id
+        self.start += 1
+
+    def unplay(self, track_id):
+        """Puts the track back in front of the cycle (when going back a track)."""
+        if track_id not in self.track_ids or track_id in self.positions:
+            return
+        if self.start > 0:
+            self.start -= 1
+            self.order[self.start] = track_id
+            self.positions[track_id] = self.start
+        else:
+            self.order.insert(0, track_id)
+            self.positions = {it: index for index, it in enumerate(self.order)}
+
+    def add(self, track_id):
+        self.track_ids.add(track_id)
+        if self.start >= len(self.order):  # Picked up by the next cycle
+            return
+        self.order.append(track_id)
+        self.positions[track_id] = len(self.order) - 1
+        swap_index = random.randint(self.start + 1, len(self.order) - 1)
+        swapped_id = self.order[swap_index]
+        self._move(swapped_id, len(self.order) - 1)
+        self._move(track_id, swap_index)
+
+    def remove(self, track_id):
+        self.track_ids.discard(track_id)
+        index = self.positions.pop(track_id, None)
+        if index is None:
+            return
+        last_id = self.order.pop()
+        if index < len(self.order):
+            self._move(last_id, index)
+
+    def get_state(self):
+        return {'order': self.order, 'start': self.start}
+
+    def set_state(self, state):
+        """Restores the cycle from get_state, skipping tracks that no longer exist."""
+        played = [it for it in state['order'][:state['start']] if it in self.track_ids]
+        upcoming = [it for it in state['order'][state['start']:] if it in self.track_ids]
+        missing = list(self.track_ids - set(played) - set(upcoming))
+        random.shuffle(missing)
+        self.order = played + upcoming + missing
+        self.start = len(played)
+        self.positions = {it: index + self.start for index, it in enumerate(self.order[self.start:])}
+
+    def _move(self, track_id, index):
+        self.order[index] = track_id
+        self.positions[track_id] = index
+
+    def _new_cycle(self, last_id):
+        self.order = list(self.track_ids)
+        random.shuffle(self.order)
+        if len(self.order) > 1 and self.order[0] == last_id:
+            swap_index = random.randint(1, len(self.order) - 1)
+            self.order[0], self.order[swap_index] = self.order[swap_index], self.order[0]
+        self.positions = {it: index for index, it in enumerate(self.order)}
+        self.start = 0
+
+
+class GuildTracklist():
+    """Write-through, in-memory copy of a guild's playlist table.
+
+    The database stays the durable copy. Every change is written there first and
+    then applied here incrementally, so the table is only read in full once.
+
+    Aggregates (total runtime, per-user track counts, and rendered explorer pages)
+    are kept up to date with each change so that reading them does not depend on
+    the size of the tracklist.
+
+    Tracks are loaded without their extra data (which holds full descriptions). It is
+    read on demand with get_extra, and only kept for the last few tracks that asked.
+
+    Tracks are ordered by their position key. Moving or inserting a track picks a key
+    between its new neighbours, so only that row changes. If the neighbouring keys
+    get too close together, every key is spaced out again.
+    """
+
+    def __init__(self, bot, guild_id):
+        self.bot = bot
+        self.guild_id = guild_id
+        self.tracks = []
+        self.total_duration = 0
+        self.user_counts = Counter()
+        self.pages = {}  # Page number: list of (track number, rendered row)
+        self.track_map = {}  # Track ID: track
+        self.extra_cache = OrderedDict()  # Track ID: extra data
+        self.shuffle_schedule = None
+        self.version = 0  # Bumped on every change
+        self.load()
+
+    def load(self):
+        """Reads the entire playlist table (adding position keys to older tables)."""
+        if data.db_exists(self.bot, 'playlist', table_suffix=self.guild_id):
+            data.db_execute(
+                self.bot, 'ALTER TABLE "playlist_{}" ADD COLUMN IF NOT EXISTS '
+                'position double precision'.format(self.guild_id))
+            data.db_execute(
+                self.bot, 'UPDATE "playlist_{}" SET position = id '
+                'WHERE position IS NULL'.format(self.guild_id))
+        cursor = data.db_select(
+            self.bot, select_arg=TRACK_SELECT, from_arg='playlist',
+            additional='ORDER BY position ASC, id ASC', table_suffix=self.guild_id)
+        self.tracks = cursor.fetchall() if cursor else []
+        self.total_duration = sum(it.duration for it in self.tracks)
+        self.user_counts = Counter(it.userid for it in self.tracks)
+        self.track_map = {it.id: it for it in self.tracks}
+        self.shuffle_schedule = ShuffleSchedule(self.track_map)
+        self.pages.clear()
+        self.version += 1
+
+    def add(self, track):
+        index = self._get_insert_index(track.position)
+        self.tracks.insert(index, track)
+        self.track_map[track.id] = track
+        self.shuffle_schedule.add(track.id)
+        self.total_duration += track.duration
+        self.user_counts[track.userid] += 1
+        self._invalidate_pages(index)
+        self.version += 1
+
+    def remove(self, track_id):
+        for index, track in enumerate(self.tracks):
+            if track.id == track_id:
+                del self.tracks[index]
+                del self.track_map[track_id]
+                self.shuffle_schedule.remove(track_id)
+                self.total_duration -= track.duration
+                self.user_counts[track.userid] -= 1
+                if self.user_counts[track.userid] <= 0:
+                    del self.user_counts[track.userid]
+                self._invalidate_pages(index)
+                self.version += 1
+                return track
+
+    def swap(self, index1, index2):
+        """Swaps the places (position keys) of the two tracks."""
+        track1, track2 = self.tracks[index1], self.tracks[index2]
+        self.tracks[index1] = track2._replace(position=track1.position)
+        self.tracks[index2] = track1._replace(position=track2.position)
+        self.track_map[track2.id] = self.tracks[index1]
+        self.track_map[track1.id] = self.tracks[index2]
+        self.pages.pop(index1 // PAGE_SIZE, None)
+        self.pages.pop(index2 // PAGE_SIZE, None)
+        self.version += 1
+
+    def set_position(self, track_id, position):
+        """Moves the track to its place for the new position key."""
+        old_index = self.tracks.index(self.track_map[track_id])
+        track = self.tracks.pop(old_index)._replace(position=position)
+        new_index = self._get_insert_index(position)
+        self.tracks.insert(new_index, track)
+        self.track_map[track_id] = track
+        self._invalidate_pages(min(old_index, new_index))
+        self.version += 1
+
+    def get_positions(self, index, count=1, exclude=None):
+        """Gets position keys that place the given number of tracks before the index.
+
+        Returns None if there is no room left between the neighbouring keys.
+
+        Keyword arguments:
+        exclude -- Track ID to leave out (the track being moved).
+        """
+        tracks = [it for it in self.tracks if it.id != exclude]
+        if not tracks:
+            return [float(it + 1) for it in range(count)]
+        elif index >= len(tracks):
+            return [tracks[-1].position + it + 1 for it in range(count)]
+        high = tracks[index].position
+        low = tracks[index - 1].position if index > 0 else high - 1
+        step = (high - low) / (count + 1)
+        positions = [low + step * (it + 1) for it in range(count)]
+        keys = [low] + positions + [high]
+        if any(first >= second for first, second in zip(keys, keys[1:])):
+            return None
+        return positions
+
+    def renumber(self):
+        """Spaces out all position keys again. Returns the new (ID, position) pairs."""
+        self.tracks[:] = [
+            track._replace(position=float(index + 1)) for index, track in enumerate(self.tracks)]
+        self.track_map = {it.id: it for it in self.tracks}
+        self.version += 1
+        return [(it.id, it.position) for it in self.tracks]
+
+    def get_extra(self, track, cache=True):
+        """Gets the extra data of the track, reading it from the database if necessary.
+
+        Keyword arguments:
+        cache -- Keeps the extra data read from the database. Disable for one-off reads,
+            so they do not push out the extra data of the current track.
+        """
+        if track.id in self.extra_cache:
+            if cache:
+                self.extra_cache.move_to_end(track.id)
+            return self.extra_cache[track.id]
+        cursor = data.db_select(
+            self.bot, select_arg='extra', from_arg='playlist', where_arg='id=%s',
+            input_args=[track.id], table_suffix=self.guild_id)
+        result = cursor.fetchone() if cursor else None
+        extra = (result.extra if result else None) or {}
+        if not cache:
+            return extra
+        self.extra_cache[track.id] = extra
+        if len(self.extra_cache) > EXTRA_CACHE_SIZE:
+            self.extra_cache.popitem(last=False)
+        return extra
+
+    def set_extra(self, track_id, url, extra):
+        """Replaces the kept extra data of the track if it is still the same track."""
+        track = self.track_map.get(track_id)
+        if track and track.url == url and track_id in self.extra_cache:
+            self.extra_cache[track_id] = extra
+
+    def clear(self):
+        del self.tracks[:]
+        self.track_map.clear()
+        self.extra_cache.clear()
+        self.shuffle_schedule = ShuffleSchedule()
+        self.total_duration = 0
+        self.user_counts.clear()
+        self.pages.clear()
+        self.version += 1
+
+    @property
+    def total_pages(self):
+        return max(int((len(self.tracks) + PAGE_SIZE - 1) / PAGE_SIZE), 1)
+
+    def get_page(self, page):
+        """Gets the rendered explorer rows for the given page."""
+        if page not in self.pages:
+            start = page * PAGE_SIZE
+            rows = []
+            for index, track in enumerate(self.tracks[start:start + PAGE_SIZE]):
+                title = _truncate_title(track.title.replace('`', '').replace('*', ''))
+                rows.append((start + index + 1, '{}**: ({}) *{}*'.format(
+                    _build_shortlink(self.bot, track),
+                    utilities.get_time_string(track.duration), title)))
+            self.pages[page] = rows
+        return self.pages[page]
+
+    def _get_insert_index(self, position):
+        """Binary searches for the index after all tracks with a key up to the position."""
+        low, high = 0, len(self.tracks)
+        while low < high:
+            middle = (low + high) // 2
+            if self.tracks[middle].position <= position:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _invalidate_pages(self, index):
+        """Removes rendered pages from the page with the given track index onwards."""
+        first_page = index // PAGE_SIZE
+        for page in [it for it in self.pages if it >= first_page]:
+            del self.pages[page]
+
+
+class StreamTee():
+    """Downloads a remote stream to a file while feeding it to ffmpeg through a pipe.
+
+    The download runs at full speed regardless of playback. A feeder thread follows the
+    growing file and writes it into the pipe, so pipe (the read end) can be given to
+    FFmpegPCMAudio straight away. Once the download finishes, the file is moved into
+    the audio cache under the given name.
+
+    The tee must be stopped once playback ends (see TeeAudioSource), otherwise the
+    feeder blocks on the full pipe forever.
+    """
+
+    def __init__(self, bot, url, name, headers=None, metrics=None):
+        self.bot = bot
+        self.url = url
+        self.name = name
+        self.headers = headers
+        self.metrics = metrics  # PlayerMetrics that get the download time and size
+        self.received = 0
+        self.finished = False  # Download is over (successfully or not)
+        self.stopped = False  # Playback is over, so nothing reads the pipe anymore
+        self.condition = threading.Condition()
+        read_descriptor, self.write_descriptor = os.pipe()
+        self.pipe = os.fdopen(read_descriptor, 'rb')
+        file_descriptor, self.file_location = tempfile.mkstemp()
+        self.cache_file = os.fdopen(file_descriptor, 'wb')
+        self.started = asyncio.get_event_loop().create_future()
+        self.download_task = asyncio.ensure_future(self._download())
+        self.feeder = threading.Thread(target=self._feed, daemon=True)
+
+    async def start(self):
+        """Waits until the first bytes arrive. Raises the download error if it fails."""
+        try:
+            await asyncio.wait_for(asyncio.shield(self.started), STREAM_TIMEOUT)
+        except Exception as e:
+            self.started.cancel()
+            self.download_task.cancel()
+            self.pipe.close()
+            os.close(self.write_descriptor)
+            raise e
+        self.stream_file = open(self.file_location, 'rb')  # Still readable once discarded
+        self.feeder.start()
+
+    async def _download(self):
+        download_start = time.time()
+        try:
+            async with aiohttp.ClientSession(headers=self.headers) as session:
+                async with session.get(self.url) as response:
+                    if response.status != 200:
+                        raise CBException("Stream failed (HTTP {}).".format(response.status))
+                    async for chunk in response.content.iter_chunked(STREAM_CHUNK):
+                        self.cache_file.write(chunk)
+                        self.cache_file.flush()
+                        with self.condition:
+                            self.received += len(chunk)
+                            self.condition.notify_all()
+                        if not self.started.done():
+                            self.started.set_result(True)
+            if not self.received:
+                raise CBException("Stream is empty.")
+        except BaseException as e:
+            logger.warn("Failed to stream %s: %r", self.name, e)
+            if not self.started.done():
+                self.started.set_exception(e)
+            self._finish()
+            self._discard()
+            return
+        self._finish()
+        if self.metrics:
+            self.metrics.observe('download_time', time.time() - download_start)
+            self.metrics.observe('download_size', self.received)
+        media_cache = self.bot.plugins['media_cache.py']
+        try:
+            file_location = await media_cache.add_audio(
+                self.bot, None, name=self.name, file_location=self.file_location)
+        except Exception as e:
+            logger.warn("Failed to cache the stream of %s: %s", self.name, e)
+            self._discard()
+            return
+        if not media_cache.owns_file(self.bot, file_location):  # Too large to cache
+            self._discard()
+
+    def stop(self):
+        """Stops feeding the pipe and closes the read end. The download continues."""
+        with self.condition:
+            if self.stopped:
+                return
+            self.stopped = True
+            self.condition.notify_all()
+        self.pipe.close()  # A feeder blocked on the full pipe gets EPIPE
+
+    def _finish(self):
+        self.cache_file.close()
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+    def _discard(self):
+        try:
+            os.remove(self.file_location)
+        except OSError:
+            pass
+
+    def _feed(self):
+        """Writes the file into the pipe as it grows (runs in its own thread)."""
+        fed = 0
+        try:
+            with self.stream_file as stream_file:
+                while True:
+                    with self.condition:
+                        while fed >= self.received and not (self.finished or self.stopped):
+                            self.condition.wait()
+                        if self.stopped or fed >= self.received:
+                            break
+                    chunk = stream_file.read(STREAM_CHUNK)
+                    if not chunk:  # File was discarded after a failure
+                        break
+                    os.write(self.write_descriptor, chunk)
+                    fed += len(chunk)
+        except OSError:  # Pipe closed by stop (track stopped or skipped)
+            pass
+        finally:
+            os.close(self.write_descriptor)
+
+
+class TeeAudioSource(discord.FFmpegPCMAudio):
+    """FFmpegPCMAudio that plays the pipe of a StreamTee and stops the tee on cleanup."""
+
+    def __init__(self, stream_tee, **kwargs):
+        self.stream_tee = stream_tee
+        super().__init__(stream_tee.pipe, pipe=True, **kwargs)
+
+    def cleanup(self):
+        super().cleanup()
+        self.stream_tee.stop()
+
+
+class PlayerRouter():
+    """Delivers gateway events only to the music player they concern.
+
+    Players are registered by guild ID (voice state updates), player message ID
+    (reaction commands), and channel ID (chat mirroring), so each event costs one
+    dictionary lookup regardless of how many players are active.
+    """
+
+    def __init__(self):
+        self.guilds = {}
+        self.messages = {}
+        self.channels = {}
+        self.routes = {}  # Guild ID: (message ID, channel ID)
+
+    def register(self, player):
+        """Registers the player, replacing the routes of its previous interface."""
+        self.unregister(player)
+        self.guilds[player.guild.id] = player
+        self.messages[player.message.id] = player
+        self.channels[player.channel.id] = player
+        self.routes[player.guild.id] = (player.message.id, player.channel.id)
+
+    def unregister(self, player):
+        if self.guilds.get(player.guild.id) is not player:
+            return
+        message_id, channel_id = self.routes.pop(player.guild.id)
+        del self.guilds[player.guild.id]
+        del self.messages[message_id]
+        del self.channels[channel_id]
+
+
+class PlayerTicker():
+    """Runs the progress refreshes and track end timers of every player.
+
+    A single task sleeps until the earliest deadline in a heap of callbacks.
+    Paused and idle players have no entries, so they are never woken up.
+    """
+
+    def __init__(self):
+        self.heap = []  # [deadline, sequence number, callback, arguments, active]
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def schedule(self, delay, callback, *args):
+        """Calls the coroutine function after the delay. Returns the entry for cancel."""
+        entry = [time.time() + delay, next(self.counter), callback, args, True]
+        heapq.heappush(self.heap, entry)
+        if self.heap[0] is entry:
+            self.wakeup.set()
+        if not self.task:
+            self.task = asyncio.ensure_future(self._run())
+        return entry
+
+    def cancel(self, entry):
+        """Marks the entry as cancelled (it is dropped when it comes up)."""
+        if entry:
+            entry[-1] = False
+
+    async def _run(self):
+        try:
+            while self.heap:
+                delay = self.heap[0][0] - time.time()
+                if delay > 0:
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                _, _, callback, args, active = heapq.heappop(self.heap)
+                if active:
+                    asyncio.ensure_future(callback(*args))
+        finally:
+            self.task = None
+
+
+class Histogram():
+    """Counts values into fixed buckets, so it uses the same memory for any number of values.
+
+    Percentiles are estimated as the upper bound of the bucket they fall in (at most
+    the largest value).
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)  # The last bucket is for larger values
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.maximum = max(self.maximum, value)
+
+    def get_percentile(self, fraction):
+        threshold = fraction * self.count
+        seen = 0
+        for index, bucket in enumerate(self.buckets):
+            seen += bucket
+            if seen and seen >= threshold:
+                if index == len(self.bounds):  # Larger than every bound
+                    return self.maximum
+                return min(self.bounds[index], self.maximum)
+        return 0
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'max': self.maximum,
+            'p50': self.get_percentile(0.5),
+            'p90': self.get_percentile(0.9),
+            'p99': self.get_percentile(0.99),
+            'buckets': {
+                str(bound): count for bound, count in
+                zip(self.bounds + ('inf',), self.buckets)}
+        }
+
+
+class PlayerMetrics():
+    """Histograms and counters of music player performance.
+
+    Values added to a player's metrics are added to the parent (aggregate) metrics as well.
+    Audio sources are read from the voice client's thread, hence the lock.
+    """
+
+    HISTOGRAMS = OrderedDict((
+        ('start_latency', TIME_BUCKETS),  # From play to the first audio frame
+        ('source_startup', TIME_BUCKETS),  # From starting the source to its first frame
+        ('track_gap', TIME_BUCKETS),  # Silence between the frames of consecutive tracks
+        ('extract_time', TIME_BUCKETS),  # Looking up the stream of a track
+        ('download_time', TIME_BUCKETS),
+        ('download_size', SIZE_BUCKETS),
+        ('edit_latency', TIME_BUCKETS)))  # Discord interface message edits
+    COUNTERS = (
+        'cache_hits', 'cache_misses', 'prefetch_hits', 'prefetch_misses',
+        'render_requests', 'render_edits',
+        'edits_dropped')  # Render requests merged into one that was already pending
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.lock = threading.Lock()
+        self.histograms = OrderedDict(
+            (name, Histogram(bounds)) for name, bounds in self.HISTOGRAMS.items())
+        self.counters = OrderedDict((it, 0) for it in self.COUNTERS)
+        self.created = time.time()
+
+    def observe(self, name, value):
+        with self.lock:
+            self.histograms[name].add(value)
+        if self.parent:
+            self.parent.observe(name, value)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+        if self.parent:
+            self.parent.count(name, amount)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'uptime': time.time() - self.created,
+                'histograms': {name: it.to_dict() for name, it in self.histograms.items()},
+                'counters': dict(self.counters)
+            }
+
+
 class MusicPlayer():
 
-    def __init__(self, bot, message, autoplay=False, track_index=None):
+    def __init__(self, bot, message, autoplay=False, track_index=None, checkpoint=None):
 
         # Discord information
         self.bot = bot
         self.channel = message.channel
         self.author = message.author
-        self.voice_channel = message.author.voice.channel
+        if checkpoint:  # Restored after a restart
+            self.voice_channel = message.guild.get_channel(checkpoint['voice_channel'])
+        else:
+            self.voice_channel = message.author.voice.channel
         self.guild = message.guild
         self.voice_client = None
         self.source = None
+        self.source_file = None  # Cached file of the source, if it is not streamed
+        self.source_url = None  # URL of the track of source_file
+        self.source_opus = False  # Whether or not source_file is an Opus transcode
+        self.source_volume = None  # Volume built into the (Opus) source
+        self.source_gain = 1.0  # Loudness normalization factor of the current track
+        self.now_playing_extra = None  # Extra data of the current track
         self.embed = None
         self.message = None  # Set later
         self.satellite_message = None
@@ -214,12 +880,15 @@ class MusicPlayer():
         self.mirror_chats = deque(maxlen=12)
 
         # Update/internal tasks
-        self.timer_task = None  # Player timer
+        self.track_timer = None  # PlayerTicker entry for the end of the track
+        self.progress_timer = None  # PlayerTicker entry for the next progress refresh
         self.command_task = None  # Waits for reaction commands
-        self.progress_task = None  # Refreshes the progress bar
-        self.state_check_task = None  # Checks voice state changes
-        self.chat_mirror_task = None  # Mirrors chat every 10 seconds
+        self.command_queue = None  # Reaction commands routed by PlayerRouter
+        self.voice_events = False  # Whether or not voice state updates are handled
         self.autoplay_task = None  # Short-lived task for autostarting the player
+        self.play_task = None  # Runs requested track transitions one at a time
+        self.prefetch_task = None  # Downloads upcoming tracks into the cache
+        self.render_task = None  # Single writer for all player messages
 
         # Player information
         self.state = States.LOADING
@@ -231,15 +900,22 @@ class MusicPlayer():
         self.progress = 0
         self.start_time = 0
         self.last_interface_update = 0
+        self.render_event = asyncio.Event()
+        self.render_immediate = False
+        self.dirty = set()  # Parts of the player messages that need to be rendered
+        self.metrics = PlayerMetrics(parent=_get_player_metrics(bot))
+        self.last_frame_time = None  # When the last audio frame was read
         self.listeners = 0
         self.skip_voters = []
         self.skip_threshold = 0.5
-        self.shuffle_stack = []
+        self.shuffle_stack = deque(maxlen=SHUFFLE_HISTORY)  # Previously shuffled track IDs
+        self.prefetch_downloads = {}  # URL: download future
         self.autopaused = False
+        self.play_request = None  # Keyword arguments of the next play transition
+        self.play_deadline = 0
+        self.last_checkpoint = 0
+        self.guild_tracklist = None
         self.tracklist = None
-        self.tracklist_url = ''
-        self.tracklist_time = 0
-        self.tracklist_update_time = 0
         self.update_tracklist()
         self.update_config()
 
@@ -247,15 +923,21 @@ class MusicPlayer():
             self.track_index = 0  # Track index in queue mode doesn't change
         else:
             if self.shuffle and self.tracklist:
-                self.track_index = random.randint(0, len(self.tracklist) - 1)
+                self.track_index = self._get_shuffle_index()
             else:
                 self.track_index = data.get(
                     self.bot, __name__, 'last_index', guild_id=self.guild.id, default=0)
                 if not 0 <= self.track_index < len(self.tracklist):
                     self.track_index = 0
 
+        # Restore the shuffle cycle and history from before a restart
+        if checkpoint and checkpoint['shuffle']:
+            self.guild_tracklist.shuffle_schedule.set_state(checkpoint['shuffle'])
+            self.shuffle_stack.extend(checkpoint['shuffle_stack'])
+
         # Build interface
-        asyncio.ensure_future(self._connect(autoplay=autoplay, track_index=track_index))
+        asyncio.ensure_future(self._connect(
+            autoplay=autoplay, track_index=track_index, checkpoint=checkpoint))
 
     def update_config(self):
         guild_id = self.guild.id
@@ -279,15 +961,13 @@ class MusicPlayer():
 
         self.volume = data.get(self.bot, __name__, 'volume', guild_id=guild_id, default=1.0)
         if self.source:
-            self.source.volume = self.volume
+            self._apply_volume()
 
         # Actively update threshold/cutoff timer
-        if self.timer_task and self.state == States.PLAYING:
-            self.timer_task.cancel()
-            self.timer_task = asyncio.ensure_future(
-                self._track_timer(*self._get_delay(config_update=True)))
+        if self.track_timer and self.state == States.PLAYING:
+            self._start_track_timer(config_update=True)
 
-    async def _connect(self, autoplay=False, track_index=None):
+    async def _connect(self, autoplay=False, track_index=None, checkpoint=None):
         is_mod = data.is_mod(self.bot, member=self.author)
         try:
             self.voice_client = await utilities.join_and_ready(
@@ -300,7 +980,9 @@ class MusicPlayer():
             await asyncio.sleep(1)  # Safety sleep
             await self._build_interface()
             # Start playback if necessary
-            if autoplay:
+            if checkpoint:
+                self.autoplay_task = asyncio.ensure_future(self._restore(checkpoint))
+            elif autoplay:
                 self.autoplay_task = asyncio.ensure_future(
                     self._autoplay(track_index=track_index))
 
@@ -311,11 +993,179 @@ class MusicPlayer():
                 raise CBException("Autoplay failed.")
             await asyncio.sleep(0.5)
             safety_timeout += 0.5
-        asyncio.ensure_future(self.play(track_index=track_index, author=self.author))
+        self.request_play(track_index=track_index, author=self.author)
+
+    async def _restore(self, checkpoint):
+        """Resumes the checkpointed track from the cache at the saved offset.
+
+        The checkpoint is kept until the track plays again (which saves a new one), so a
+        failed restore is attempted again on the next start.
+        """
+        safety_timeout = 0
+        while self.state == States.LOADING:
+            if safety_timeout > 30:
+                raise CBException("Restoring the player failed.")
+            await asyncio.sleep(0.5)
+            safety_timeout += 0.5
+        if self.mode == Modes.PLAYLIST:
+            track = self.guild_tracklist.track_map.get(checkpoint['track']['id'])
+        else:
+            track = Track(**checkpoint['track'])
+        if track is None:  # Removed from the playlist
+            data.remove(self.bot, __name__, 'checkpoint', guild_id=self.guild.id, safe=True)
+            return
+
+        media_cache = self.bot.plugins['media_cache.py']
+        opus_name = track.url + OPUS_SUFFIX
+        use_opus = (
+            configurations.get(self.bot, __name__, 'opus_playback') and
+            media_cache.has_audio(self.bot, opus_name))
+        sound_file = media_cache.get_audio(self.bot, opus_name if use_opus else track.url)
+        if not sound_file:
+            try:
+                sound_file = await self._download_audio(track.url)
+            except Exception as e:
+                logger.warn("Failed to restore track %s: %s", track.url, e)
+                return
+        if self.state != States.PAUSED or self.now_playing:  # Started by someone else
+            return
+
+        # Same as play, but starting at the offset
+        self.now_playing = track
+        self.now_playing_extra = checkpoint['extra']
+        if self.mode == Modes.PLAYLIST:
+            self.track_index = self.tracklist.index(track)
+            self.page = int(self.track_index / PAGE_SIZE)
+        self.first_time_startup = False
+        self.source_gain = _get_gain_factor(self.bot, self.now_playing_extra)
+        self._set_source_file(sound_file, track.url, opus=use_opus)
+        self.source = self._get_audio_source(offset=checkpoint['progress'])
+        self._play_source(self.source)
+        self.progress = checkpoint['progress']
+        self.start_time = time.time()
+        if checkpoint['paused']:
+            self.voice_client.pause()
+            self._save_checkpoint()
+        else:
+            self.state = States.PLAYING
+            self._start_track_timer()
+            self.schedule_prefetch()
+        self.notification = 'The player was restored after a restart'
+        asyncio.ensure_future(self.update_interface(ignore_ratelimit=True))
+
+    def _save_checkpoint(self):
+        """Saves what is needed to restore the player after a restart."""
+        self.last_checkpoint = time.time()
+        if not self.now_playing or not self.message:
+            return
+        if self.state == States.PLAYING:
+            progress = self.progress + time.time() - self.start_time
+        else:
+            progress = self.progress
+        shuffle = self.mode == Modes.PLAYLIST and self.shuffle
+        checkpoint = {
+            'time': time.time(),
+            'channel': self.channel.id,
+            'voice_channel': self.voice_channel.id,
+            'messages': [self.message.id, self.satellite_message.id, self.mirror_message.id],
+            'track': self.now_playing._asdict(),
+            'extra': self.now_playing_extra,
+            'progress': progress,
+            'paused': self.state != States.PLAYING,
+            'shuffle': self.guild_tracklist.shuffle_schedule.get_state() if shuffle else None,
+            'shuffle_stack': list(self.shuffle_stack)
+        }
+        data.add(self.bot, __name__, 'checkpoint', checkpoint, guild_id=self.guild.id)
 
     def update_tracklist(self):
-        self.tracklist_update_time = time.time()
-        self.tracklist = _get_tracklist(self.bot, self.guild)
+        self.guild_tracklist = _get_guild_tracklist(self.bot, self.guild)
+        self.tracklist = self.guild_tracklist.tracks
+        if self.state == States.PLAYING:
+            self.schedule_prefetch()
+
+    def update_track_index(self):
+        """Points the track index at the current track again after tracks were moved."""
+        if self.mode == Modes.PLAYLIST and self.now_playing:
+            track = self.guild_tracklist.track_map.get(self.now_playing.id)
+            if track:
+                self.track_index = self.tracklist.index(track)
+
+    def schedule_prefetch(self):
+        """Restarts the prefetch stage for the upcoming tracks."""
+        if self.prefetch_task:
+            self.prefetch_task.cancel()
+            self.prefetch_task = None
+        if self.state != States.STOPPED and self.tracklist:
+            self.prefetch_task = asyncio.ensure_future(self._prefetch())
+
+    async def _prefetch(self):
+        """Downloads the upcoming tracks into the audio cache during playback."""
+        media_cache = self.bot.plugins['media_cache.py']
+        upcoming = self._get_upcoming_tracks()
+        upcoming_urls = [it.url for it in upcoming]
+        for url, download in list(self.prefetch_downloads.items()):
+            if download.done() and url not in upcoming_urls:
+                self._discard_prefetch(url)
+        for track in upcoming:
+            if track.url in self.prefetch_downloads:
+                continue
+            if media_cache.has_audio(self.bot, track.url):
+                continue
+            logger.debug("Prefetching track %s", track.title)
+            download = asyncio.ensure_future(self._download_audio(track.url))
+            self.prefetch_downloads[track.url] = download
+            try:
+                sound_file = await asyncio.shield(download)
+            except asyncio.CancelledError:
+                raise  # Tracklist changed; the download itself keeps going
+            except Exception as e:
+                logger.warn("Failed to prefetch track %s: %s", track.url, e)
+                del self.prefetch_downloads[track.url]
+                continue
+            _schedule_audio_processing(
+                self.bot, self.guild, track,
+                self.guild_tracklist.get_extra(track, cache=False), sound_file)
+
+    def _discard_prefetch(self, url):
+        """Forgets the prefetched download, releasing its file once it finishes."""
+        download = self.prefetch_downloads.pop(url)
+
+        def _release(download):
+            if not download.cancelled() and not download.exception():
+                _release_audio_file(self.bot, url, download.result())
+
+        download.add_done_callback(_release)
+
+    def _set_source_file(self, sound_file, url, opus=False):
+        """Sets the file to play, releasing the previous one."""
+        if self.source_file and self.source_file != sound_file:
+            _release_audio_file(self.bot, self.source_url, self.source_file)
+        self.source_file, self.source_url, self.source_opus = sound_file, url, opus
+
+    def _get_upcoming_tracks(self, count=PREFETCH_COUNT):
+        """Gets the tracks that will be played next, in order."""
+        if not self.tracklist:
+            return []
+        if self.mode == Modes.QUEUE:  # The current track is already out of the queue
+            upcoming = list(self.tracklist[:count])
+        elif self.shuffle:
+            upcoming = self._get_shuffle_tracks(count)
+        else:
+            total_tracks = len(self.tracklist)
+            upcoming = [
+                self.tracklist[(self.track_index + delta) % total_tracks]
+                for delta in range(1, min(count, total_tracks) + 1)]
+        return [it for it in upcoming if it and it != self.now_playing]
+
+    def _get_shuffle_tracks(self, count=1):
+        """Gets the next tracks of the shuffle schedule."""
+        last_id = self.now_playing.id if self.now_playing else None
+        track_ids = self.guild_tracklist.shuffle_schedule.peek(count, last_id=last_id)
+        return [self.guild_tracklist.track_map[it] for it in track_ids]
+
+    def _get_shuffle_index(self):
+        """Gets the track index of the next track of the shuffle schedule."""
+        return self.tracklist.index(self._get_shuffle_tracks()[0])
 
     async def update_state(self):
         if self.state == States.STOPPED:
@@ -351,12 +1201,7 @@ class MusicPlayer():
 
         if self.command_task:
             self.command_task.cancel()
-        if self.progress_task:
-            self.progress_task.cancel()
-        if self.state_check_task:
-            self.state_check_task.cancel()
-        if self.chat_mirror_task:
-            self.chat_mirror_task.cancel()
+        _get_player_router(self.bot).unregister(self)
         if self.message:
             for old_message in (self.message, self.satellite_message, self.mirror_message):
                 try:
@@ -389,27 +1234,38 @@ class MusicPlayer():
         self.embed = embed
         self.message = await self.channel.send(embed=embed)
         self.command_task = asyncio.ensure_future(self._command_listener(resume=resume))
+        if not self.render_task:
+            self.render_task = asyncio.ensure_future(self._render_loop())
 
-    async def _progress_loop(self):
-        """Refreshes the progress bar."""
-        await asyncio.sleep(5)
-        while True:
-            await self.update_state()
-            if self.state == States.PLAYING:
-                self.update_listeners(update_interface=False)
-                if time.time() - self.last_interface_update >= 4:
-                    asyncio.ensure_future(self.update_interface())
-                asyncio.ensure_future(self.update_satellite())
-                await asyncio.sleep(5)
-            elif self.state in (States.PAUSED, States.LOADING):
-                # TODO: Implement idle timeout
-                await asyncio.sleep(1)
-            else:  # Stopped
-                logger.warn("Progress loop wasn't cancelled for some reason. Stopping loop...")
-                return
+    def _schedule_progress(self):
+        """Schedules the next progress refresh on the shared ticker.
 
-    async def _chat_mirror_loop(self):
-        """Mirrors chat messages after 10 seconds."""
+        Refreshes happen on a fixed phase per guild so that the edits of different
+        players are spread out over the interval instead of bursting together.
+        """
+        _get_player_ticker(self.bot).cancel(self.progress_timer)
+        phase = (self.guild.id >> 22) % 1000 / 1000 * PROGRESS_INTERVAL
+        now = time.time()
+        delay = PROGRESS_INTERVAL - (now - phase) % PROGRESS_INTERVAL
+        self.progress_timer = _get_player_ticker(self.bot).schedule(delay, self._refresh_progress)
+
+    async def _refresh_progress(self):
+        """Refreshes the progress bar. Stops rescheduling once the player is not playing."""
+        self.progress_timer = None
+        await self.update_state()
+        if self.state == States.PLAYING:
+            self.update_listeners(update_interface=False)
+            if time.time() - self.last_interface_update >= 4:
+                self.request_render('title', 'info')
+            self.request_render('satellite')
+            if time.time() - self.last_checkpoint >= CHECKPOINT_INTERVAL:
+                self._save_checkpoint()
+            self._schedule_progress()
+        elif self.state == States.LOADING:  # Interface or track is loading
+            self._schedule_progress()
+
+    def handle_message(self, message):
+        """Mirrors chat messages after 10 seconds (routed by PlayerRouter)."""
 
         async def _delete_and_update(message):
             await asyncio.sleep(MIRROR_TIMER)
@@ -422,29 +1278,22 @@ class MusicPlayer():
             else:
                 await self.update_mirror(new_chat=message)
 
-        while True:
-            message = await self.bot.wait_for('message')
-            if (not self.mirror_chat or
-                    not message or
-                    self.state == States.STOPPED or
-                    message.channel != self.channel):
-                continue
+        if not self.mirror_chat or self.state == States.STOPPED:
+            return
 
-            # Don't log player messages by the bot or non-standard messages (like pins)
-            player_messages = (self.message.id, self.satellite_message.id, self.mirror_message.id)
-            if message.type is discord.MessageType.default and message.id not in player_messages:
-                asyncio.ensure_future(_delete_and_update(message))
+        # Don't log player messages by the bot or non-standard messages (like pins)
+        player_messages = (self.message.id, self.satellite_message.id, self.mirror_message.id)
+        if message.type is discord.MessageType.default and message.id not in player_messages:
+            asyncio.ensure_future(_delete_and_update(message))
 
-    async def _listener_loop(self):
-        """Checks the state of members in the voice channel."""
+    def handle_voice_state(self, member, before, after):
+        """Checks the state of members in the voice channel (routed by PlayerRouter)."""
 
         class VoiceChange(Enum):
             NORMAL, LEFT, JOINED = range(3)
 
         def check(member, before, after):
-            if member.guild != self.guild:
-                return VoiceChange.NORMAL
-            elif not member == self.bot.user and (member.bot or not (before or after)):
+            if not member == self.bot.user and (member.bot or not (before or after)):
                 return VoiceChange.NORMAL
             elif after and after.channel == self.voice_channel:
                 if not before or before.channel != self.voice_channel:
@@ -454,57 +1303,49 @@ class MusicPlayer():
                     return VoiceChange.LEFT
             return VoiceChange.NORMAL
 
-        # Preliminary check
-        self.listeners = len([it for it in self.voice_channel.members if not it.bot])
+        if not self.voice_events or self.state == States.STOPPED:
+            return
 
-        # Wait on voice state updates to determine users entering/leaving
-        while True:
-            result = await self.bot.wait_for('voice_state_update')
-            if not result:
-                continue
-            elif self.state == States.STOPPED:
+        # Check for self changes
+        if member == self.bot.user:
+            if not after:  # Disconnected
+                # TODO: Consider adding failsafe stop
+                logger.warn("Voice disconnected, detected from handle_voice_state.")
+                self.voice_events = False
                 return
-            member, before, after = result
+            if before != after:
+                logger.debug("Bot was dragged to a new voice channel.")
+                if after.channel == self.guild.afk_channel:  # TODO: Act on AFK channel
+                    logger.warn("Moved to the AFK channel. Failsafe stopping.")
+                self.voice_channel = after.channel
+                self.voice_client = self.guild.voice_client
+
+        # Update listener count
+        self.listeners = len([it for it in self.voice_channel.members if not it.bot])
+        logger.debug("Voice state updated. Listeners: %s", self.listeners)
+        self.update_listeners(update_interface=False)
 
-            # Check for self changes
-            if member == self.bot.user and member.guild == self.guild:
-                if not after:  # Disconnected
-                    # TODO: Consider adding failsafe stop
-                    logger.warn("Voice disconnected, detected from _listener_loop.")
-                    return
-                if before != after:
-                    logger.debug("Bot was dragged to a new voice channel.")
-                    if after.channel == self.guild.afk_channel:  # TODO: Act on AFK channel
-                        logger.warn("Moved to the AFK channel. Failsafe stopping.")
-                    self.voice_channel = after.channel
-                    self.voice_client = self.guild.voice_client
-
-            # Update listener count
-            self.listeners = len([it for it in self.voice_channel.members if not it.bot])
-            logger.debug("Voice state updated. Listeners: %s", self.listeners)
-            self.update_listeners(update_interface=False)
+        voice_change = check(member, before, after)
+        if voice_change is VoiceChange.LEFT:
+            if member.id in self.skip_voters:
+                self.skip_voters.remove(member.id)
+            asyncio.ensure_future(self.update_interface(ignore_ratelimit=True))
+        elif voice_change is VoiceChange.JOINED:
+            asyncio.ensure_future(self.update_interface(ignore_ratelimit=True))
 
-            voice_change = check(*result)
-            if voice_change is VoiceChange.LEFT:
-                if member.id in self.skip_voters:
-                    self.skip_voters.remove(member.id)
-                asyncio.ensure_future(self.update_interface(ignore_ratelimit=True))
-            elif voice_change is VoiceChange.JOINED:
-                asyncio.ensure_future(self.update_interface(ignore_ratelimit=True))
-
-            if self.listeners == 0:
-                if self.auto_disconnect:
-                    asyncio.ensure_future(
-                        self.stop(
-                            text=(
-                                "The player has been stopped due to all users leaving the channel."
-                            )
+        if self.listeners == 0:
+            if self.auto_disconnect:
+                asyncio.ensure_future(
+                    self.stop(
+                        text=(
+                            "The player has been stopped due to all users leaving the channel."
                         )
                     )
-                else:
-                    self.autopaused = True
-                    self.notification = "The player has been automatically paused"
-                    asyncio.ensure_future(self.pause())
+                )
+            else:
+                self.autopaused = True
+                self.notification = "The player has been automatically paused"
+                asyncio.ensure_future(self.pause())
 
     def update_listeners(self, update_interface=True):
         """Updates the number of listeners and skips the song if enough people have voted."""
@@ -528,29 +1369,125 @@ class MusicPlayer():
             asyncio.ensure_future(self.update_interface(ignore_ratelimit=True))
 
     async def update_interface(self, notification_text='', ignore_ratelimit=False):
-        """Calls the other functions to update the main interface."""
-        await self.update_notification(text=notification_text)
-        await self.update_title()
-        await self.update_info()
-        await self.update_footer()
-        if not ignore_ratelimit and time.time() - self.last_interface_update < 1:
-            return
-        try:
-            await self.message.edit(content=None, embed=self.embed)
-            self.last_interface_update = time.time()
-        except discord.NotFound:
-            await self.reset_player_messages()
+        """Schedules a refresh of the main interface.
+
+        Keyword arguments:
+        notification_text -- Replaces the current notification if given.
+        ignore_ratelimit -- Renders without waiting for other requests to arrive.
+            Edits are still limited to one per message per render window.
+        """
+        if notification_text:
+            self.notification = notification_text
+        self.request_render(*INTERFACE_FLAGS, immediate=ignore_ratelimit)
 
     async def update_satellite(self):
-        """Updates the satellite with track data."""
+        """Schedules a refresh of the satellite."""
+        self.request_render('satellite')
+
+    async def update_mirror(self, new_notification=None, new_chat=None):
+        """Adds notification or chat data and schedules a refresh of the mirror."""
+        if new_notification:
+            self._add_mirror_notification(new_notification)
+        if new_chat:
+            self.mirror_chats.append(new_chat)
+        self.request_render('mirror')
+
+    def request_render(self, *flags, immediate=False):
+        """Marks the given parts of the player messages as dirty.
+
+        Flags can be any of title, info, footer, notification, satellite, and mirror.
+        """
+        new_flags = set(flags) - self.dirty
+        targets = self._get_render_targets(flags)
+        self.metrics.count('render_requests', len(targets))
+        merged = targets & self._get_render_targets(self.dirty)
+        if merged:  # Already waiting on a render of the same messages
+            self.metrics.count('edits_dropped', len(merged))
+        self.dirty.update(new_flags)
+        self.render_immediate |= immediate
+        self.render_event.set()
+
+    @property
+    def edits_saved(self):
+        """Number of message edits avoided by coalescing render requests."""
+        return self.metrics.counters['edits_dropped']
+
+    def _get_render_targets(self, flags):
+        targets = set(it for it in ('satellite', 'mirror') if it in flags)
+        if any(it in flags for it in INTERFACE_FLAGS):
+            targets.add('interface')
+        return targets
+
+    async def _render_loop(self):
+        """Renders dirty parts of the player messages with coalesced edits."""
+        last_edit_times = {'interface': 0, 'satellite': 0, 'mirror': 0}
+        while True:
+            await self.render_event.wait()
+            delay = 0 if self.render_immediate else RENDER_DELAY
+            targets = self._get_render_targets(self.dirty)
+            if targets:
+                next_allowed = max(last_edit_times[it] for it in targets) + RENDER_WINDOW
+                delay = max(delay, next_allowed - time.time())
+            await asyncio.sleep(delay)
+
+            self.render_event.clear()
+            self.render_immediate = False
+            flags, self.dirty = self.dirty, set()
+            if self.state == States.STOPPED:
+                return
+            if self.loading_interface and not self.message:
+                continue
+            try:
+                for target in await self._render(flags):
+                    last_edit_times[target] = time.time()
+            except asyncio.CancelledError:
+                raise
+            except discord.NotFound:
+                await self.reset_player_messages()
+            except Exception as e:
+                logger.warn("Failed to render the player interface: %s", e)
+
+    async def _render(self, flags):
+        """Rebuilds the dirty parts and edits each affected message once.
+
+        Returns the messages that were edited.
+        """
+        edited = []
+        if any(it in flags for it in INTERFACE_FLAGS):
+            if 'notification' in flags:
+                await self.update_notification()
+            if 'title' in flags:
+                await self.update_title()
+            if 'info' in flags:
+                await self.update_info()
+            if 'footer' in flags:
+                await self.update_footer()
+            edit_start = time.time()
+            await self.message.edit(content=None, embed=self.embed)
+            self.last_interface_update = time.time()
+            self.metrics.observe('edit_latency', self.last_interface_update - edit_start)
+            edited.append('interface')
+        if 'mirror' in self.dirty:  # New notification from this render
+            self.dirty.remove('mirror')
+            flags.add('mirror')
+        if 'satellite' in flags and await self._render_satellite():
+            edited.append('satellite')
+        if 'mirror' in flags:
+            await self._render_mirror()
+            edited.append('mirror')
+        self.metrics.count('render_edits', len(edited))
+        return edited
+
+    async def _render_satellite(self):
+        """Updates the satellite with track data. Returns True if it was edited."""
 
         if not self.now_playing and self.satellite_data:  # Player stopped
             self.satellite_data = None
             await self.satellite_message.edit(embed=discord.Embed())
-            return
-        elif not self.now_playing or self.now_playing.extra == self.satellite_data:
-            return
-        self.satellite_data = extra = self.now_playing.extra
+            return True
+        elif not self.now_playing or self.now_playing_extra == self.satellite_data:
+            return False
+        self.satellite_data = extra = self.now_playing_extra
 
         embed = discord.Embed()
         keys = ('uploader', 'views', 'likes', 'dislikes', 'uploaded')
@@ -573,21 +1510,16 @@ class MusicPlayer():
         if 'artist_thumbnail' in extra:
             embed.set_thumbnail(url=extra['artist_thumbnail'])
 
-        try:
-            await self.satellite_message.edit(embed=embed)
-        except discord.NotFound:
-            await self.reset_player_messages()
-
-    async def update_mirror(self, new_notification=None, new_chat=None):
-        """Updates the mirror message with notification or chat data."""
+        await self.satellite_message.edit(embed=embed)
+        return True
 
-        if new_notification:
-            if new_notification != self.mirror_last_notification:
-                self.mirror_last_notification = new_notification
-                self.mirror_notifications.append(new_notification)
-        if new_chat:
-            self.mirror_chats.append(new_chat)
+    def _add_mirror_notification(self, notification):
+        if notification != self.mirror_last_notification:
+            self.mirror_last_notification = notification
+            self.mirror_notifications.append(notification)
 
+    async def _render_mirror(self):
+        """Updates the mirror message with notification and chat data."""
         embed = discord.Embed()
         while sum(len(it) for it in self.mirror_notifications) > 1000:
             self.mirror_notifications.popleft()
@@ -638,10 +1570,7 @@ class MusicPlayer():
                     index + 1, name='Recent chat messages:' if index == 0 else '\u200b',
                     value='\u200b' + '\n'.join(segment), inline=False)
 
-        try:
-            await self.mirror_message.edit(embed=embed)
-        except discord.NotFound:
-            await self.reset_player_messages()
+        await self.mirror_message.edit(embed=embed)
 
     async def update_footer(self):
         """Updates volume display, control type, and player mode in the footer."""
@@ -701,24 +1630,17 @@ class MusicPlayer():
             len(self.skip_voters), math.ceil(self.listeners * self.skip_threshold))
         self.embed.set_field_at(2, name=new_name, value=new_value, inline=False)
 
-        # Tracklist slice
+        # Tracklist page
         total_tracks = len(self.tracklist)
-        total_duration = sum(it.duration for it in self.tracklist)
-        total_pages = max(int((total_tracks + 4) / 5), 1)
+        total_duration = self.guild_tracklist.total_duration
+        total_pages = self.guild_tracklist.total_pages
         self.page %= total_pages
-        displayed_tracks = self.tracklist[self.page * 5:(self.page * 5) + 5]
-
-        # Build individual track entries from slice
-        info = ['---'] * 5 + ['Page [ {} / {} ]'.format(self.page + 1, total_pages)]
-        for index, entry in enumerate(displayed_tracks):
-            duration = utilities.get_time_string(entry.duration)
-            entry_index = (self.page * 5) + index + 1
-            full_title = entry.title.replace('`', '').replace('*', '')
-            title = _truncate_title(full_title)
+
+        # Add the playing indicator to the rendered rows
+        info = ['---'] * PAGE_SIZE + ['Page [ {} / {} ]'.format(self.page + 1, total_pages)]
+        for index, (entry_index, row) in enumerate(self.guild_tracklist.get_page(self.page)):
             use_indicator = entry_index == self.track_index + 1 and self.mode == Modes.PLAYLIST
-            info[index] = ('**[`{}{}`]{}**: ({}) *{}*'.format(
-                '▶ ' if use_indicator else '', entry_index,
-                _build_shortlink(self.bot, entry), duration, title))
+            info[index] = '**[`{}{}`]{}'.format('▶ ' if use_indicator else '', entry_index, row)
         new_value = '\n'.join(info)
 
         # Total tracks and runtime
@@ -762,13 +1684,12 @@ class MusicPlayer():
 
         # Show next track if available
         if next_index != -1:
+            if self.mode == Modes.PLAYLIST and self.shuffle and self.now_playing:
+                next_index = self._get_shuffle_index()
             next_track = self.tracklist[next_index]
             if next_index >= 0:
-                if self.mode == Modes.PLAYLIST and self.shuffle:
-                    new_value += '\nUp next: [Track ?]'
-                else:
-                    new_value += '\nUp next: {}'.format(
-                        _build_track_details(self.bot, next_track, next_index))
+                new_value += '\nUp next: {}'.format(
+                    _build_track_details(self.bot, next_track, next_index))
 
         self.embed.set_field_at(1, name=new_name, value=new_value, inline=False)
 
@@ -778,31 +1699,113 @@ class MusicPlayer():
         elif not self.notification:
             self.notification = 'No notification.'
         if self.notification != self.mirror_last_notification:
-            asyncio.ensure_future(self.update_mirror(new_notification=self.notification))
+            self._add_mirror_notification(self.notification)
+            self.dirty.add('mirror')
         self.embed.set_field_at(4, name='Notification:', value=self.notification)
 
     def _skip_track(self):
         """Skips the current track (even if paused)."""
-        delta = 1 if self.mode == Modes.PLAYLIST else 0
-        if self.mode == Modes.PLAYLIST and self.shuffle:
-            if self.now_playing:
-                self.shuffle_stack.append(self.now_playing.id)
-            if len(self.tracklist) > 1:
-                new_track_index = random.randint(0, len(self.tracklist) - 2)
-                if new_track_index >= self.track_index:
-                    new_track_index += 1
-            else:
-                new_track_index = 0
+        self.request_play(skips=1)
+
+    def request_play(self, coalesce=False, **kwargs):
+        """Requests a call to play with the given keyword arguments.
+
+        Transitions run one at a time, and only the latest request is kept while one
+        is waiting. Skips (skips=n, negative to go back) add up instead, and are turned
+        into a track index only right before the transition. A track that was cut short
+        (skipped) is still reported if its request is replaced.
+
+        Keyword arguments:
+        coalesce -- Waits a moment for further navigation before changing tracks, so
+            that a burst of skips results in a single transition.
+        """
+        pending = self.play_request
+        if pending:
+            if 'skips' in kwargs and 'skips' in pending:
+                kwargs['skips'] += pending['skips']
+            skipped = kwargs.get('skipped') or pending.get('skipped')
+            if skipped:
+                kwargs['skipped'] = skipped
+        self.play_request = kwargs
+        self.play_deadline = time.time() + NAVIGATION_DELAY if coalesce else 0
+        if not self.play_task:
+            self.play_task = asyncio.ensure_future(self._play_actor())
+
+    async def _play_actor(self):
+        try:
+            while self.play_request is not None:
+                delay = self.play_deadline - time.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                request, self.play_request = self.play_request, None
+                if 'skips' in request:
+                    request['track_index'] = self._resolve_skips(request.pop('skips'))
+                try:
+                    await self.play(**request)
+                except Exception as e:
+                    logger.warn("Failed to change tracks: %s", e)
+        finally:
+            self.play_task = None
+
+    def _resolve_skips(self, skips):
+        """Gets the track index that is the given number of skips ahead (or back).
+
+        Skipped tracks are handled as if they were played: they are marked as played
+        in the shuffle cycle, or taken out of the queue. Going back in shuffle mode
+        walks the shuffle stack one track at a time, so the result is the same as
+        navigating track by track.
+        """
+        if not self.tracklist:
+            return 0
+        elif self.mode == Modes.QUEUE:
+            for track in self.tracklist[:max(skips - 1, 0)]:
+                _remove_track_from_db(self.bot, self.guild, track)
+            self.update_tracklist()
+            return 0
+        elif self.shuffle:
+            schedule = self.guild_tracklist.shuffle_schedule
+            current = self.now_playing
+            for step in range(abs(skips)):
+                if step:  # Tracks stepped over count as played
+                    schedule.mark_played(current.id)
+                previous = None
+                if skips < 0 and self.shuffle_stack:  # Check shuffle stack first
+                    previous = self.guild_tracklist.track_map.get(self.shuffle_stack.pop())
+                if previous:
+                    if current:  # Comes up next again
+                        schedule.unplay(current.id)
+                    current = previous
+                else:
+                    if current:
+                        self.shuffle_stack.append(current.id)
+                    current = self._get_shuffle_tracks()[0]
+            if current in self.tracklist:
+                return self.tracklist.index(current)
+            return self.track_index
         else:
-            new_track_index = self.track_index + delta
-        asyncio.ensure_future(self.play(track_index=new_track_index))
-
-    async def _track_timer(self, sleeptime, use_skip=False):
-        """Sleeps until the end of the song or cutoff. Plays the next track afterwards."""
-        logger.debug("Sleeping for %s seconds. Time: %s", sleeptime, time.time())
-        track_check = self.now_playing
-        await asyncio.sleep(sleeptime)
-        logger.debug("Finished sleeping for %s seconds. Time: %s", sleeptime, time.time())
+            return (self.track_index + skips) % len(self.tracklist)
+
+    def _start_track_timer(self, config_update=False):
+        """Schedules the end of the song or cutoff, and the progress refreshes."""
+        self._cancel_track_timer()
+        sleeptime, use_skip = self._get_delay(config_update=config_update)
+        logger.debug("Track ends in %s seconds. Time: %s", sleeptime, time.time())
+        self.track_timer = _get_player_ticker(self.bot).schedule(
+            sleeptime, self._track_timer, self.now_playing, use_skip)
+        self._schedule_progress()
+        self._save_checkpoint()
+
+    def _cancel_track_timer(self):
+        ticker = _get_player_ticker(self.bot)
+        ticker.cancel(self.track_timer)
+        ticker.cancel(self.progress_timer)
+        self.track_timer = self.progress_timer = None
+
+    async def _track_timer(self, track_check, use_skip=False):
+        """Plays the next track at the end of the song or cutoff."""
+        logger.debug("Track timer finished. Time: %s", time.time())
+        self.track_timer = None
         await self.update_state()
         if self.state == States.STOPPED or track_check != self.now_playing:
             logger.debug("The track timer resumed?")
@@ -810,19 +1813,8 @@ class MusicPlayer():
         while self.state == States.LOADING:
             logger.warn("Player was moved while the track was loading.")
             await asyncio.sleep(1)
-        if self.mode == Modes.PLAYLIST and self.shuffle:
-            logger.debug("Adding track %s to the shuffle stack", track_check.title)
-            self.shuffle_stack.append(track_check.id)
-            if len(self.tracklist) > 1:
-                new_track_index = random.randint(0, len(self.tracklist) - 2)
-                if new_track_index >= self.track_index:
-                    new_track_index += 1
-            else:
-                new_track_index = 0
-            asyncio.ensure_future(self.play(track_index=new_track_index, skipped=use_skip))
-        else:
-            logger.debug('_track_timer is moving on: %s', use_skip)
-            asyncio.ensure_future(self.play(skipped=use_skip))
+        logger.debug('_track_timer is moving on: %s', use_skip)
+        self.request_play(skips=1, skipped=use_skip)
 
     def _get_delay(self, config_update=False):  # Gets track delay with cutoff
         if self.now_playing.duration > self.threshold:
@@ -850,6 +1842,7 @@ class MusicPlayer():
         # Ignore loading player
         if self.state in (States.LOADING, States.STOPPED):
             return
+        requested = time.time()
 
         # Resume player if paused
         if (self.state == States.PAUSED and
@@ -857,7 +1850,7 @@ class MusicPlayer():
             self.state = States.PLAYING
             self.voice_client.resume()
             self.start_time = time.time()
-            self.timer_task = asyncio.ensure_future(self._track_timer(*self._get_delay()))
+            self._start_track_timer()
             author_text = '{} resumed the player'.format(author.mention) if author else ''
             asyncio.ensure_future(self.update_interface(notification_text=author_text))
             self.autopaused = False  # Reset single-time resume state
@@ -921,36 +1914,67 @@ class MusicPlayer():
                 if track_index is None:
                     track_index = 0
                 track = self.tracklist[0 if track_index == -1 else track_index]
-                data.db_delete(
-                    self.bot, 'playlist', table_suffix=self.guild.id,
-                    where_arg='id=%s', input_args=[track.id])
+                self.guild_tracklist.get_extra(track)  # Kept for after the row is removed
+                _remove_track_from_db(self.bot, self.guild, track)
                 self.update_tracklist()
 
         self.autopaused = False  # Reset single-time resume state
 
         # Setup the player
         logger.debug("Preparing to play the next track.")
-        self.page = int(self.track_index / 5)
+        self.page = int(self.track_index / PAGE_SIZE)
         del self.skip_voters[:]
         if self.state == States.PLAYING:
             if self.voice_client.is_playing():
                 self.voice_client.stop()
-        if self.timer_task:
-            self.timer_task.cancel()
+        else:  # Only measure the gap between tracks played back to back
+            self.last_frame_time = None
+        self._cancel_track_timer()
         self.first_time_startup = not bool(self.now_playing)
         self.state = States.LOADING
+        if track is not self.now_playing:
+            self.now_playing_extra = self.guild_tracklist.get_extra(track)
         self.now_playing = track
-        sound_file = data.get_from_cache(self.bot, None, url=track.url)
-
-        # Audio not found in cache, download now instead
+        if self.mode == Modes.PLAYLIST and self.shuffle:
+            self.guild_tracklist.shuffle_schedule.mark_played(track.id)
+        self.source_gain = _get_gain_factor(self.bot, self.now_playing_extra)
+        media_cache = self.bot.plugins['media_cache.py']
+        opus_name = track.url + OPUS_SUFFIX
+        use_opus = (
+            configurations.get(self.bot, __name__, 'opus_playback') and
+            media_cache.has_audio(self.bot, opus_name))
+        sound_file = media_cache.get_audio(self.bot, opus_name if use_opus else track.url)
+        opus_file = sound_file if use_opus else None
+        self.metrics.count('cache_hits' if sound_file else 'cache_misses')
+
+        # Wait on the prefetched download if it has not finished yet
+        prefetch_download = self.prefetch_downloads.get(track.url)
+        if not sound_file and prefetch_download:
+            del self.prefetch_downloads[track.url]
+            try:
+                sound_file = await asyncio.shield(prefetch_download)
+            except Exception as e:
+                logger.warn("Prefetched download failed for %s: %s", track.url, e)
+        elif prefetch_download:  # Already cached (as an Opus transcode)
+            self._discard_prefetch(track.url)
+        if sound_file and prefetch_download:
+            self.metrics.count('prefetch_hits')
+
+        # Audio not found in cache, stream it (or download now instead)
+        audio_source = None
         if not sound_file:
+            self.metrics.count('prefetch_misses')
+            logger.debug(
+                "Prefetch missed (%s hits, %s misses)",
+                self.metrics.counters['prefetch_hits'], self.metrics.counters['prefetch_misses'])
             asyncio.ensure_future(self.update_interface())
-            logger.debug("Not found in cache. Downloading...")
+            if configurations.get(self.bot, __name__, 'stream_while_caching'):
+                audio_source = await self._get_stream_source(track)
 
+        if not sound_file and not audio_source:
+            logger.debug("Not found in cache. Downloading...")
             try:
-                options = {'format': 'bestaudio/best', 'noplaylist': True}
-                downloader = YoutubeDL(options)
-                sound_file = await data.add_to_cache_ydl(self.bot, downloader, track.url)
+                sound_file = await self._download_audio(track.url)
             except Exception as e:  # Attempt to redownload from base url
                 logger.warn("Failed to download track %s\n%s", track.url, e)
                 self.notification = "Failed to download {}. Failsafe skipping...".format(
@@ -960,21 +1984,23 @@ class MusicPlayer():
                 return
 
         # TODO: Add exception handling
-        # TODO: Change ffmpeg_options for docker version
-        #ffmpeg_options = '-protocol_whitelist "file,http,https,tcp,tls"'
-        #audio_source = discord.FFmpegPCMAudio(sound_file, before_options=ffmpeg_options)
-        audio_source = discord.FFmpegPCMAudio(sound_file)
+        if audio_source:  # Streamed
+            self._set_source_file(None, None)
+        else:
+            _schedule_audio_processing(
+                self.bot, self.guild, track, self.now_playing_extra, sound_file)
+            self._set_source_file(sound_file, track.url, opus=bool(opus_file))
+            audio_source = self._get_audio_source()
 
-        # Set volume and play audio
-        audio_source = discord.PCMVolumeTransformer(audio_source, volume=self.volume)
-        self.voice_client.play(audio_source)
+        # Play audio
+        self._play_source(audio_source, requested=requested)
         self.source = audio_source
 
         # Record progress time
         self.progress = 0
         self.start_time = time.time()
         self.state = States.PLAYING
-        self.timer_task = asyncio.ensure_future(self._track_timer(*self._get_delay()))
+        self._start_track_timer()
         if skipped:
             self.notification = (
                 'The track *{}* was cut short because it exceeded '
@@ -985,16 +2011,134 @@ class MusicPlayer():
 
         asyncio.ensure_future(self.update_interface(ignore_ratelimit=True))
         data.add(self.bot, __name__, 'last_index', self.track_index, guild_id=self.guild.id)
+        self.schedule_prefetch()
+
+    async def _get_stream_source(self, track):
+        """Starts streaming the track while it is saved to the audio cache.
+
+        Returns None if the stream could not be started, so the track is downloaded instead.
+        """
+        logger.debug("Not found in cache. Streaming...")
+        try:
+            media_cache = self.bot.plugins['media_cache.py']
+            extract_start = time.time()
+            info = await media_cache.extract_info(self.bot, track.url, streams=True)
+            self.metrics.observe('extract_time', time.time() - extract_start)
+            stream_format = info if info.get('url') else info['formats'][0]
+            stream_tee = StreamTee(
+                self.bot, stream_format['url'], track.url,
+                headers=stream_format.get('http_headers'), metrics=self.metrics)
+            await stream_tee.start()
+        except Exception as e:
+            logger.warn("Failed to stream track %s, downloading instead: %s", track.url, e)
+            return None
+        audio_nodes = _get_audio_nodes(self.bot)
+        if audio_nodes:
+            return audio_nodes.open_stream(
+                stream_tee.pipe, self.volume * self.source_gain, bitrate=OPUS_BITRATE)
+        audio_source = TeeAudioSource(stream_tee)
+        return discord.PCMVolumeTransformer(audio_source, volume=self.volume * self.source_gain)
+
+    async def _download_audio(self, url):
+        """Downloads the track into the audio cache and records the download metrics."""
+        download_start = time.time()
+        sound_file = await self.bot.plugins['media_cache.py'].download_audio(self.bot, url)
+        self.metrics.observe('download_time', time.time() - download_start)
+        self.metrics.observe('download_size', os.path.getsize(sound_file))
+        return sound_file
+
+    def _play_source(self, audio_source, requested=None):
+        """Plays the audio source and records when its frames are read.
+
+        The read method of the source is wrapped, as the voice client gives no signal
+        of when playback actually starts.
+
+        Keyword arguments:
+        requested -- Time the track was requested to play. Given for new tracks to
+            measure the start latency and the gap after the previous track.
+        """
+        source_start = time.time()
+        read = audio_source.read
+        first_frame = True
+
+        def _read():
+            nonlocal first_frame
+            frame = read()
+            if not frame:
+                return frame
+            frame_time = time.time()
+            if first_frame:
+                first_frame = False
+                self.metrics.observe('source_startup', frame_time - source_start)
+                if requested:
+                    self.metrics.observe('start_latency', frame_time - requested)
+                    if self.last_frame_time:
+                        self.metrics.observe('track_gap', frame_time - self.last_frame_time)
+            self.last_frame_time = frame_time
+            return frame
+
+        audio_source.read = _read
+        self.voice_client.play(audio_source)
+
+    def _get_audio_source(self, offset=0):
+        """Builds the audio source for source_file, starting at the given offset.
+
+        With Opus playback, ffmpeg applies the volume and loudness gain, and outputs Opus
+        directly. Opus transcodes already include the gain, so they are passed through
+        without being encoded again when played at full volume.
+
+        With audio nodes, decoding and encoding happen in a node process instead.
+        """
+        before_options = '-ss {:.2f}'.format(offset) if offset else None
+        self.source_volume = self.volume
+        audio_nodes = _get_audio_nodes(self.bot)
+        if audio_nodes:
+            volume = self.volume * (1.0 if self.source_opus else self.source_gain)
+            return audio_nodes.open_stream(
+                self.source_file, volume, before_options=before_options, bitrate=OPUS_BITRATE)
+        if configurations.get(self.bot, __name__, 'opus_playback'):
+            if self.source_opus and self.volume == 1.0:
+                return discord.FFmpegOpusAudio(
+                    self.source_file, codec='copy', before_options=before_options)
+            volume = self.volume * (1.0 if self.source_opus else self.source_gain)
+            return discord.FFmpegOpusAudio(
+                self.source_file, bitrate=OPUS_BITRATE, before_options=before_options,
+                options='-filter:a volume={:.3f}'.format(volume))
+        audio_source = discord.FFmpegPCMAudio(self.source_file, before_options=before_options)
+        return discord.PCMVolumeTransformer(audio_source, volume=self.volume * self.source_gain)
+
+    def _apply_volume(self):
+        """Applies the volume to the current source, restarting it if necessary."""
+        if isinstance(self.source, discord.PCMVolumeTransformer):
+            self.source.volume = self.volume * self.source_gain
+            return
+        elif isinstance(self.source, audio_node.NodeAudioSource):  # Changed by the node
+            self.source_volume = self.volume
+            self.source.volume = self.volume * (1.0 if self.source_opus else self.source_gain)
+            return
+        if self.volume == self.source_volume or not self.source_file:
+            return
+        if self.state == States.PLAYING:
+            offset = self.progress + time.time() - self.start_time
+        elif self.state == States.PAUSED and self.progress:
+            offset = self.progress
+        else:
+            return
+        self.source = self._get_audio_source(offset=offset)
+        self.voice_client.stop()
+        self._play_source(self.source)
+        if self.state == States.PAUSED:
+            self.voice_client.pause()
 
     async def pause(self, author=None):
         if (self.state in (States.PAUSED, States.LOADING, States.STOPPED) or
                 self.voice_client is None or not self.voice_client.is_playing()):
             return
-        if self.timer_task:
-            self.timer_task.cancel()
+        self._cancel_track_timer()
         self.voice_client.pause()
         self.state = States.PAUSED
         self.progress += time.time() - self.start_time
+        self._save_checkpoint()
         author_text = '{} paused the player'.format(author.mention) if author else ''
         asyncio.ensure_future(self.update_interface(
             notification_text=author_text, ignore_ratelimit=True))
@@ -1004,19 +2148,23 @@ class MusicPlayer():
         await utilities.stop_audio(self.bot, self.guild)
         self.state = States.STOPPED
         self.now_playing = None
+        data.remove(self.bot, __name__, 'checkpoint', guild_id=self.guild.id, safe=True)
         try:
             if self.voice_client:
                 self.voice_client.stop()
-            if self.timer_task:
-                self.timer_task.cancel()
+            self._cancel_track_timer()
             if self.command_task:
                 self.command_task.cancel()
-            if self.progress_task:
-                self.progress_task.cancel()
-            if self.state_check_task:
-                self.state_check_task.cancel()
-            if self.chat_mirror_task:
-                self.chat_mirror_task.cancel()
+            if self.play_task:
+                self.play_task.cancel()
+            _get_player_router(self.bot).unregister(self)
+            if self.prefetch_task:
+                self.prefetch_task.cancel()
+            for url in list(self.prefetch_downloads):
+                self._discard_prefetch(url)
+            self._set_source_file(None, None)
+            if self.render_task:
+                self.render_task.cancel()
         except Exception as e:
             logger.warn("Failed to stop some task. %s", e)
         try:
@@ -1060,34 +2208,18 @@ class MusicPlayer():
             track_details = ''
         self.notification = skip_format.format(member.mention, track_details)
 
-        # Determine track delta
+        # Steps are added up with other pending navigation
         if self.mode == Modes.PLAYLIST:
-            # Repeat track if more than 10 seconds have elapsed
-            start_delta = 1 if self.now_playing else 0
-            delta = start_delta if use_skip else (0 if use_repeat else -1)
+            if use_skip:
+                skips = 1 if self.now_playing else 0
+            else:  # Repeat track if more than 10 seconds have elapsed
+                skips = 0 if use_repeat else -1
+            self.request_play(coalesce=True, skips=skips)
+        elif use_skip and self.now_playing:
+            self.request_play(coalesce=True, skips=1)
         else:
             delta = 0 if use_skip else -1
-
-        if self.mode == Modes.PLAYLIST and self.shuffle and delta != 0:
-            last_track = None
-            if not use_skip and self.shuffle_stack:  # Check shuffle stack first
-                last_track_id = self.shuffle_stack.pop()
-                for new_track_index, track in enumerate(self.tracklist):
-                    if track.id == last_track_id:
-                        last_track = track
-                        break
-            if last_track is None:
-                if self.now_playing:
-                    self.shuffle_stack.append(self.now_playing.id)
-                if len(self.tracklist) > 1:
-                    new_track_index = random.randint(0, len(self.tracklist) - 2)
-                    if new_track_index >= self.track_index:
-                        new_track_index += 1
-                else:
-                    new_track_index = 0
-        else:
-            new_track_index = self.track_index + delta
-        asyncio.ensure_future(self.play(track_index=new_track_index))
+            self.request_play(coalesce=True, track_index=self.track_index + delta)
         return True
 
     async def _command_listener(self, resume=False):
@@ -1113,10 +2245,12 @@ class MusicPlayer():
             await asyncio.sleep(1)
             self.loading_interface = False
 
-        self.progress_task = asyncio.ensure_future(self._progress_loop())
-        self.state_check_task = asyncio.ensure_future(self._listener_loop())
-        self.chat_mirror_task = asyncio.ensure_future(self._chat_mirror_loop())
-        self.page = int(self.track_index / 5)
+        self.listeners = len([it for it in self.voice_channel.members if not it.bot])
+        self.voice_events = True
+        self.command_queue = asyncio.Queue()
+        _get_player_router(self.bot).register(self)
+        self._save_checkpoint()  # New player messages
+        self.page = int(self.track_index / PAGE_SIZE)
         asyncio.ensure_future(self.update_interface())
         asyncio.ensure_future(_add_buttons())
 
@@ -1127,13 +2261,10 @@ class MusicPlayer():
         try:  # TODO: Remove try/except block
             while True:
                 # Wait on reaction command
-                kwargs = {'check': lambda r, u: r.message.id == self.message.id and not u.bot}
                 logger.debug("Waiting on command...")
-                result = await self.bot.wait_for('reaction_add', **kwargs)
-                if result is None or self.state == States.STOPPED:
+                result = await self.command_queue.get()
+                if self.state == States.STOPPED:
                     return
-                elif result[1] == self.bot.user:
-                    continue
 
                 # Check validity of reaction
                 command, member = result[0].emoji, result[1]
@@ -1168,7 +2299,7 @@ class MusicPlayer():
                             asyncio.ensure_future(self.pause(author=member))
                         elif self.state == States.PAUSED:
                             if permissions or self.autopaused or self.first_time_startup:
-                                asyncio.ensure_future(self.play(author=member))
+                                self.request_play(author=member)
 
                     # Skip
                     elif self.state != States.LOADING:
@@ -1187,30 +2318,23 @@ class MusicPlayer():
                         self.shuffle = not self.shuffle
                         data.add(
                             self.bot, __name__, 'shuffle', self.shuffle, guild_id=self.guild.id)
+                        if self.state == States.PLAYING:
+                            self.schedule_prefetch()
                     asyncio.ensure_future(self.update_interface())
 
                 # Generate tracklist
                 elif command == valid_commands[5]:
                     logger.debug("Tracklist selected")
                     if self.tracklist:
-                        if self.tracklist_time != self.tracklist_update_time:
-                            self.tracklist_time = self.tracklist_update_time
-                            tracklist_string = await _build_tracklist(
-                                self.bot, self.guild, self.tracklist)
-                            tracklist_file = utilities.get_text_as_file(tracklist_string)
-                            url = await utilities.upload_to_discord(
-                                self.bot, tracklist_file, filename='tracklist.txt')
-                            self.tracklist_url = url
-
-                        text = '[Click here]({}) to download the tracklist'.format(
-                            self.tracklist_url)
+                        url = await _get_tracklist_url(self.bot, self.guild)
+                        text = '[Click here]({}) to download the tracklist'.format(url)
                         asyncio.ensure_future(self.update_interface(notification_text=text))
 
                 # Track list navigation
                 elif command in valid_commands[6:9]:
                     logger.debug("Track list navigation selected")
                     if command == valid_commands[7]:  # Reset to the current page
-                        self.page = int(self.track_index / 5)
+                        self.page = int(self.track_index / PAGE_SIZE)
                     else:
                         self.page += -1 if command == valid_commands[6] else 1
                     asyncio.ensure_future(self.update_interface(ignore_ratelimit=True))
@@ -1260,7 +2384,7 @@ class MusicPlayer():
                         'To add tracks:\n`{0}`\u200b{1[3].help_string}\n'
                         'To remove tracks:\n`{0}`\u200b{1[4].help_string}\n'
                         'To add tracks and/or skip to a track:\n'
-                        '`{0}`\u200b{1[11].help_string}\n\n'
+                        '`{0}`\u200b{1[12].help_string}\n\n'
                         'Examples (using the shortcut):\n'
                         '`{0}add Erasure Always`\n'
                         '`{0}remove 1`\n'
@@ -1311,10 +2435,207 @@ def _truncate_title(text, limit=TITLE_LIMIT):
     return (text[:limit] + '…') if len(text) > limit else text
 
 
+def _schedule_audio_processing(bot, guild, track, extra, sound_file):
+    """Measures the loudness of the cached track and transcodes it to Opus in the background.
+
+    Steps that are disabled or were already done are skipped. The loudness is measured
+    first so that the gain can be built into the Opus transcode. A transcode that was
+    made before the gain was measured is made again with the gain.
+    """
+    normalize = configurations.get(bot, __name__, 'loudness_normalization')
+    use_opus = configurations.get(bot, __name__, 'opus_playback')
+    measure = normalize and 'gain' not in extra
+    transcode = use_opus and not bot.plugins['media_cache.py'].has_audio(
+        bot, track.url + OPUS_SUFFIX)
+    if not (measure or transcode):
+        return
+    processing = data.get(bot, __name__, 'audio_processing', volatile=True)
+    if processing is None:
+        processing = {}
+        data.add(bot, __name__, 'audio_processing', processing, volatile=True)
+    if track.url not in processing:
+        processing[track.url] = asyncio.ensure_future(
+            _process_audio(bot, guild, track, extra, sound_file, measure, transcode))
+        processing[track.url].add_done_callback(
+            lambda *args: processing.pop(track.url, None))
+
+
+async def _process_audio(bot, guild, track, extra, sound_file, measure, transcode):
+    gain = extra.get('gain', 0)
+    if measure:
+        gain = await _measure_gain(bot, sound_file)
+        if gain is None:  # Failed, but the track can still be transcoded without it
+            gain = 0
+        else:
+            extra = dict(extra, gain=gain)
+            data.db_update(
+                bot, 'playlist', table_suffix=guild.id, set_arg='extra=%s',
+                where_arg='id=%s AND url=%s', input_args=[Json(extra), track.id, track.url])
+            _get_guild_tracklist(bot, guild).set_extra(track.id, track.url, extra)
+            # A cached Opus transcode was made before the gain was known, so replace it
+            if gain and not transcode and configurations.get(bot, __name__, 'opus_playback'):
+                transcode = bot.plugins['media_cache.py'].has_audio(bot, track.url + OPUS_SUFFIX)
+    if transcode:
+        await _transcode_to_opus(bot, track.url, sound_file, gain=gain)
+
+
+async def _measure_gain(bot, sound_file):
+    """Gets the gain in decibels that brings the file to the target loudness.
+
+    The measurement runs in a separate thread pool so that it does not block the event
+    loop or take up the default executor. Returns None if the measurement fails.
+    """
+    analysis_pool = data.get(bot, __name__, 'analysis_pool', volatile=True)
+    if analysis_pool is None:
+        workers = configurations.get(bot, __name__, 'analysis_workers')
+        analysis_pool = ThreadPoolExecutor(max_workers=workers)
+        data.add(bot, __name__, 'analysis_pool', analysis_pool, volatile=True)
+    try:
+        loudness = await asyncio.get_event_loop().run_in_executor(
+            analysis_pool, _measure_loudness, sound_file)
+    except Exception as e:
+        logger.warn("Failed to measure the loudness of %s: %s", sound_file, e)
+        return None
+    if not math.isfinite(loudness):  # Silence
+        return 0.0
+    target = configurations.get(bot, __name__, 'loudness_target')
+    return round(max(min(target - loudness, MAX_GAIN), -MAX_GAIN), 1)
+
+
+def _measure_loudness(sound_file):
+    """Measures the integrated loudness of the file in LUFS with ffmpeg's loudnorm filter."""
+    result = subprocess.run(
+        ['ffmpeg', '-nostdin', '-hide_banner', '-i', sound_file, '-vn',
+            '-af', 'loudnorm=print_format=json', '-f', 'null', '-'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    output = result.stderr.decode('utf8', 'replace')
+    return float(json.loads(output[output.rindex('{'):output.rindex('}') + 1])['input_i'])
+
+
+def _get_gain_factor(bot, extra):
+    """Gets the loudness normalization volume factor from the extra data of a track."""
+    if not configurations.get(bot, __name__, 'loudness_normalization'):
+        return 1.0
+    return 10 ** (extra.get('gain', 0) / 20)
+
+
+async def _transcode_to_opus(bot, url, sound_file, gain=0):
+    file_descriptor, opus_file = tempfile.mkstemp(suffix='.ogg')
+    os.close(file_descriptor)
+    filter_arguments = ['-af', 'volume={}dB'.format(gain)] if gain else []
+    try:
+        process = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-nostdin', '-y', '-loglevel', 'error', '-i', sound_file, '-vn',
+            *filter_arguments, '-c:a', 'libopus', '-b:a', '{}k'.format(OPUS_BITRATE),
+            '-ar', '48000', '-ac', '2', '-f', 'ogg', opus_file, stderr=asyncio.subprocess.PIPE)
+        _, error = await process.communicate()
+        if process.returncode != 0:
+            raise CBException(
+                "ffmpeg exited with code {}.".format(process.returncode),
+                error.decode('utf8', 'replace'))
+        media_cache = bot.plugins['media_cache.py']
+        cached_file = await media_cache.add_audio(
+            bot, None, name=url + OPUS_SUFFIX, file_location=opus_file)
+        if not media_cache.owns_file(bot, cached_file):  # Too large to cache
+            _remove_file(cached_file)
+        logger.debug("Transcoded %s to Opus", url)
+    except Exception as e:
+        logger.warn("Failed to transcode %s to Opus: %s", url, e)
+        _remove_file(opus_file)
+
+
+def _release_audio_file(bot, url, sound_file):
+    """Removes the audio file of the track if the audio cache did not keep it.
+
+    Files too large for the cache belong to the player. Background processing of the
+    track is waited on first, as it may still be reading the file.
+    """
+    if not sound_file or bot.plugins['media_cache.py'].owns_file(bot, sound_file):
+        return
+    processing = data.get(bot, __name__, 'audio_processing', volatile=True) or {}
+    if url in processing:
+        processing[url].add_done_callback(lambda *args: _remove_file(sound_file))
+    else:
+        _remove_file(sound_file)
+
+
+def _remove_file(file_location):
+    try:
+        os.remove(file_location)
+    except OSError:
+        pass
+
+
+def _get_pinned_tracks(bot):
+    """Gets the audio cache names of tracks in guilds with an active player."""
+    pinned = []
+    for guild in bot.guilds:
+        music_player = data.get(bot, __name__, 'music_player', guild_id=guild.id, volatile=True)
+        if not music_player:
+            continue
+        tracks = list(music_player.tracklist or [])
+        if music_player.now_playing:
+            tracks.append(music_player.now_playing)
+        for track in tracks:
+            pinned.extend((track.url, track.url + OPUS_SUFFIX))
+    return pinned
+
+
+def _get_audio_nodes(bot):
+    """Gets the audio node pool, or None if playback is encoded in this process."""
+    if not configurations.get(bot, __name__, 'audio_node'):
+        return None
+    audio_nodes = data.get(bot, __name__, 'audio_nodes', volatile=True)
+    if audio_nodes is None:
+        workers = configurations.get(bot, __name__, 'audio_node_workers')
+        audio_nodes = audio_node.AudioNodePool(workers, logger=logger)
+        data.add(bot, __name__, 'audio_nodes', audio_nodes, volatile=True)
+    return audio_nodes
+
+
+def _get_player_ticker(bot):
+    player_ticker = data.get(bot, __name__, 'player_ticker', volatile=True)
+    if player_ticker is None:
+        player_ticker = PlayerTicker()
+        data.add(bot, __name__, 'player_ticker', player_ticker, volatile=True)
+    return player_ticker
+
+
+def _get_player_metrics(bot):
+    """Gets the aggregate metrics of all music players."""
+    player_metrics = data.get(bot, __name__, 'player_metrics', volatile=True)
+    if player_metrics is None:
+        player_metrics = PlayerMetrics()
+        data.add(bot, __name__, 'player_metrics', player_metrics, volatile=True)
+    return player_metrics
+
+
+def _get_player_router(bot):
+    player_router = data.get(bot, __name__, 'player_router', volatile=True)
+    if player_router is None:
+        player_router = PlayerRouter()
+        data.add(bot, __name__, 'player_router', player_router, volatile=True)
+    return player_router
+
+
+def _get_guild_tracklist(bot, guild):
+    """Gets the in-memory tracklist model for the guild, loading it if necessary."""
+    guild_tracklist = data.get(bot, __name__, 'tracklist', guild_id=guild.id, volatile=True)
+    if guild_tracklist is None:
+        guild_tracklist = GuildTracklist(bot, guild.id)
+        data.add(bot, __name__, 'tracklist', guild_tracklist, guild_id=guild.id, volatile=True)
+    return guild_tracklist
+
+
 def _get_tracklist(bot, guild):
-    cursor = data.db_select(
-        bot, from_arg='playlist', additional='ORDER BY id ASC', table_suffix=guild.id)
-    return cursor.fetchall() if cursor else ()
+    return _get_guild_tracklist(bot, guild).tracks
+
+
+def _remove_track_from_db(bot, guild, track):
+    """Removes the given track from the database and the tracklist model."""
+    data.db_delete(
+        bot, 'playlist', table_suffix=guild.id, where_arg='id=%s', input_args=[track.id])
+    _get_guild_tracklist(bot, guild).remove(track.id)
 
 
 def _get_music_player(bot, guild):
@@ -1336,8 +2657,12 @@ async def _check_active_player(bot, guild, autodelete_time=5):
     return music_player, use_player_interface, autodelete
 
 
-def _check_total_tracks_limits(bot, author):
-    """Ensures that limits of the track list are respected. Returns tracklist."""
+def _check_total_tracks_limits(bot, author, pending=0):
+    """Ensures that limits of the track list are respected. Returns tracklist.
+
+    Keyword arguments:
+    pending -- Tracks by the author that are about to be added but are not stored yet.
+    """
 
     # Limits
     user_track_limit = data.get(
@@ -1348,22 +2673,32 @@ def _check_total_tracks_limits(bot, author):
         default=configurations.get(bot, __name__, key='max_total_track_limit'))
 
     # Checks
-    tracklist = _get_tracklist(bot, author.guild)
+    guild_tracklist = _get_guild_tracklist(bot, author.guild)
+    tracklist = guild_tracklist.tracks
     if data.has_custom_role(bot, __name__, 'dj', member=author):  # DJs ignore limits
         return tracklist
-    if total_track_limit and len(tracklist) >= total_track_limit:
+    if total_track_limit and len(tracklist) + pending >= total_track_limit:
         raise CBException("The track limit of {} has been reached.".format(total_track_limit))
-    user_tracks = [it for it in tracklist if it.userid == author.id]
-    if user_track_limit and len(user_tracks) >= user_track_limit:
+    user_tracks = guild_tracklist.user_counts[author.id] + pending
+    if user_track_limit and user_tracks >= user_track_limit:
         raise CBException(
             "You cannot add any more songs right now (limit {}).".format(user_track_limit))
     return tracklist
 
 
-async def _add_track_with_url(bot, guild, check_url, user_id=0, timestamp=0):
+async def _add_track_with_url(bot, guild, check_url, user_id=0, timestamp=0, index=None):
     """Checks the given url and adds it to the database."""
-    options = {'format': 'bestaudio/best', 'noplaylist': True, 'default-search': 'ytsearch'}
-    downloader = YoutubeDL(options)
+    check_url, info = await _extract_track_info(bot, check_url)
+    return await _add_track_to_db(
+        bot, guild, check_url, info, user_id=user_id, timestamp=timestamp, index=index)
+
+
+async def _extract_track_info(bot, check_url):
+    """Gets the track information of the given URL or search query.
+
+    Returns the (possibly resolved) URL and the information.
+    """
+    media_cache = bot.plugins['media_cache.py']
 
     # Check for a direct URL (SO: 7160737)
     try:
@@ -1377,20 +2712,25 @@ async def _add_track_with_url(bot, guild, check_url, user_id=0, timestamp=0):
 
     # Get information about the track
     try:
-        info = await utilities.future(downloader.extract_info, check_url, download=False)
-        if not is_url:  # Select first result on search
-            info = info['entries'][0]
+        info = await media_cache.extract_info(bot, check_url)
+        if not is_url:  # First result of the search
             check_url = info['webpage_url']
     except BotException as e:
         raise e  # Pass up
     except Exception as e:
         raise CBException("Failed to fetch information from the URL.", e=e)
-    return await _add_track_to_db(
-        bot, guild, check_url, info, user_id=user_id, timestamp=timestamp)
+    return check_url, info
 
 
-async def _add_track_to_db(bot, guild, check_url, info, user_id=0, timestamp=0):
+async def _add_track_to_db(bot, guild, check_url, info, user_id=0, timestamp=0, index=None):
     """Adds the given track info to the database."""
+    entry_data = await _get_track_entry(
+        bot, check_url, info, user_id=user_id, timestamp=timestamp)
+    return _insert_tracks(bot, guild, [entry_data], index=index)[0]
+
+
+async def _get_track_entry(bot, check_url, info, user_id=0, timestamp=0):
+    """Checks the given track info and builds the row data for insertion."""
     hard_threshold = configurations.get(bot, __name__, key='hard_threshold')
     bot.extra = info
     try:
@@ -1406,12 +2746,15 @@ async def _add_track_to_db(bot, guild, check_url, info, user_id=0, timestamp=0):
         uploader = info.get('uploader', None)
         if 'duration' in info:
             duration = int(info['duration'])
-        else:  # Manual download and check
-            extension = chosen_format['ext']
-            sound_file, filename = await utilities.download_url(
-                bot, download_url, extension=extension, include_name=True)
-            duration = int(TinyTag.get(sound_file).duration)
-            utilities.delete_temporary_file(bot, filename)
+        else:  # Probe the file without downloading all of it
+            media_cache = bot.plugins['media_cache.py']
+            # Cached stream URLs may have expired
+            info = await media_cache.extract_info(bot, check_url, streams=True)
+            chosen_format = info['formats'][0]
+            download_url = chosen_format['url']
+            duration = int(await media_cache.probe_duration(
+                bot, download_url, extension=chosen_format.get('ext'), limit=hard_threshold,
+                headers=chosen_format.get('http_headers')))
     except BotException as e:
         raise e  # Pass up
     except Exception as e:
@@ -1447,10 +2790,58 @@ async def _add_track_to_db(bot, guild, check_url, info, user_id=0, timestamp=0):
         timestamp if timestamp else time.time(),
         Json(extra_data)
     ]
-
-    return data.db_insert(
-        bot, 'playlist', table_suffix=guild.id, input_args=entry_data,
-        create='playlist_template')
+    return entry_data
+
+
+def _insert_tracks(bot, guild, entries, index=None):
+    """Inserts the given track rows with a single statement. Returns the new tracks.
+
+    Keyword arguments:
+    index -- Inserts the tracks before this track index instead of at the end.
+    """
+    if not data.db_exists(bot, 'playlist', table_suffix=guild.id):
+        data.db_create_table(bot, 'playlist', table_suffix=guild.id, template='playlist_template')
+    guild_tracklist = _get_guild_tracklist(bot, guild)
+    if index is None:
+        index = len(guild_tracklist.tracks)
+    positions = _get_positions(bot, guild, index, count=len(entries))
+    columns = TRACK_COLUMNS + ('position',)
+    row_template = '({})'.format(', '.join(['%s'] * len(columns)))
+    cursor = data.db_execute(
+        bot, 'INSERT INTO "playlist_{}" ({}) VALUES {} RETURNING {}'.format(
+            guild.id, ', '.join(columns), ', '.join([row_template] * len(entries)),
+            TRACK_SELECT),
+        input_args=[
+            it for entry, position in zip(entries, positions) for it in entry + [position]])
+    tracks = sorted(cursor.fetchall(), key=lambda it: it.position)
+    for track in tracks:
+        guild_tracklist.add(track)
+    return tracks
+
+
+def _move_track(bot, guild, track, index):
+    """Moves the track before the given index (of the other tracks) by changing one key."""
+    position = _get_positions(bot, guild, index, exclude=track.id)[0]
+    data.db_update(
+        bot, 'playlist', table_suffix=guild.id, set_arg='position=%s',
+        where_arg='id=%s', input_args=[position, track.id])
+    _get_guild_tracklist(bot, guild).set_position(track.id, position)
+
+
+def _get_positions(bot, guild, index, count=1, exclude=None):
+    """Gets new position keys, spacing out every key first if there is no room left."""
+    guild_tracklist = _get_guild_tracklist(bot, guild)
+    positions = guild_tracklist.get_positions(index, count=count, exclude=exclude)
+    if positions is None:
+        logger.debug("Renumbering the playlist positions of guild %s", guild.id)
+        renumbered = guild_tracklist.renumber()
+        data.db_execute(
+            bot, 'UPDATE "playlist_{}" AS track SET position = new.position FROM '
+            '(VALUES {}) AS new (id, position) WHERE track.id = new.id'.format(
+                guild.id, ', '.join(['(%s, %s)'] * len(renumbered))),
+            input_args=[it for pair in renumbered for it in pair])
+        positions = guild_tracklist.get_positions(index, count=count, exclude=exclude)
+    return positions
 
 
 async def add_track(bot, context):
@@ -1480,17 +2871,20 @@ async def add_track(bot, context):
 
     # Add track to the playlist
     check_url = context.arguments[0]
+    index = context.options.get('at')
     try:
         tracklist = _check_total_tracks_limits(bot, context.author)
-        cursor = await _add_track_with_url(
-            bot, context.guild, check_url, user_id=context.author.id)
-        track = cursor.fetchone()
+        if index is not None and not 1 <= index <= len(tracklist) + 1:
+            raise CBException("Position must be between 1 and {}".format(len(tracklist) + 1))
+        track = await _add_track_with_url(
+            bot, context.guild, check_url, user_id=context.author.id,
+            index=None if index is None else index - 1)
     except BotException as e:
         e.autodelete = autodelete
         raise e
 
     response = '{} added {}'.format(
-        context.author.mention, _build_track_details(bot, track, len(tracklist)))
+        context.author.mention, _build_track_details(bot, track, tracklist.index(track)))
     if track.duration > threshold:
         response += (
             "\nTrack is longer than the threshold length ({} seconds), so "
@@ -1500,6 +2894,7 @@ async def add_track(bot, context):
     music_player, use_player_interface, autodelete = await _check_active_player(bot, context.guild)
     if use_player_interface:
         music_player.update_tracklist()
+        music_player.update_track_index()
         await music_player.update_interface(notification_text=response)
 
     return Response(
@@ -1532,9 +2927,7 @@ async def remove_track(bot, context):
         raise CBException(
             "You must be the user who added the entry, or a DJ.", autodelete=autodelete)
 
-    data.db_delete(
-        bot, 'playlist', table_suffix=context.guild.id,
-        where_arg='id=%s', input_args=[track.id])
+    _remove_track_from_db(bot, context.guild, track)
     response = '{} removed {}'.format(
         context.author.mention, _build_track_details(bot, track, index))
 
@@ -1556,6 +2949,31 @@ async def remove_track(bot, context):
         extra=autodelete if use_player_interface else None)
 
 
+async def _get_track_authors(bot, guild, user_ids):
+    """Resolves only the given user IDs into members (or 'Unknown').
+
+    Members are taken from the gateway member cache first. The rest are requested
+    with as few member queries as possible instead of fetching every guild member.
+    """
+    authors = {}
+    missing = []
+    for user_id in set(user_ids):
+        member = guild.get_member(user_id)
+        if member:
+            authors[user_id] = member
+        else:
+            missing.append(user_id)
+    for index in range(0, len(missing), MEMBER_QUERY_LIMIT):
+        batch = missing[index:index + MEMBER_QUERY_LIMIT]
+        try:
+            members = await guild.query_members(user_ids=batch, limit=len(batch), cache=True)
+        except Exception as e:
+            logger.warn("Failed to look up tracklist members: %s", e)
+            break
+        authors.update((it.id, it) for it in members)
+    return {it: authors.get(it, 'Unknown') for it in user_ids}
+
+
 async def _build_tracklist(bot, guild, tracklist):
     header = (
         '# Tracklist generated: {3[1]} {3[0]}\r\n'
@@ -1575,11 +2993,9 @@ async def _build_tracklist(bot, guild, tracklist):
         '  Added by {} at {} {}\r\n'  # Info
         '  Duration: {} ID|Timestamp: {}|{}\r\n'  # Duration, internal info
     )
-    all_guild_members = await guild.fetch_members(limit=None).flatten()
+    track_authors = await _get_track_authors(bot, guild, [it.userid for it in tracklist])
     for index, track in enumerate(tracklist):
-        track_author = (
-            (await data.fetch_member(bot, track.userid, safe=True, search=all_guild_members)) or
-            'Unknown')
+        track_author = track_authors[track.userid]
         offset, upload_time = utilities.get_timezone_offset(
             bot, guild_id=guild.id, utc_seconds=track.timestamp, as_string=True)
         upload_time_text = time.strftime('%H:%M %m/%d/%Y', time.gmtime(upload_time))
@@ -1590,6 +3006,30 @@ async def _build_tracklist(bot, guild, tracklist):
     return '\r\n'.join(tracklist_text_list)
 
 
+async def _get_tracklist_export(bot, guild):
+    """Gets the tracklist text, reusing the last export if the tracklist is unchanged."""
+    guild_tracklist = _get_guild_tracklist(bot, guild)
+    version = guild_tracklist.version
+    export = data.get(bot, __name__, 'tracklist_export', guild_id=guild.id, volatile=True)
+    if not export or export['version'] != version:
+        # Snapshot, as the tracklist can change while the track authors are fetched
+        tracklist = list(guild_tracklist.tracks)
+        text = await _build_tracklist(bot, guild, tracklist)
+        export = {'version': version, 'text': text, 'url': None}
+        data.add(bot, __name__, 'tracklist_export', export, guild_id=guild.id, volatile=True)
+    return export
+
+
+async def _get_tracklist_url(bot, guild):
+    """Uploads the tracklist file once per tracklist version and returns its URL."""
+    export = await _get_tracklist_export(bot, guild)
+    if not export['url']:
+        tracklist_file = utilities.get_text_as_file(export['text'])
+        export['url'] = await utilities.upload_to_discord(
+            bot, tracklist_file, filename='tracklist.txt')
+    return export['url']
+
+
 async def format_tracklist(bot, context):
     music_player, use_player_interface, autodelete = await _check_active_player(bot, context.guild)
 
@@ -1598,15 +3038,14 @@ async def format_tracklist(bot, context):
     if not tracklist:
         raise CBException("The playlist queue is empty.", autodelete=autodelete)
 
-    tracklist_string = await _build_tracklist(bot, context.guild, tracklist)
-    tracklist_file = utilities.get_text_as_file(tracklist_string)
-
     if use_player_interface:
-        url = await utilities.upload_to_discord(bot, tracklist_file, filename='tracklist.txt')
+        url = await _get_tracklist_url(bot, context.guild)
         await music_player.update_interface(
             notification_text='[Click here]({}) to download the current tracklist'.format(url))
         return Response(content='Tracklist file updated.', delete_after=5)
     else:
+        export = await _get_tracklist_export(bot, context.guild)
+        tracklist_file = utilities.get_text_as_file(export['text'])
         return Response(
             content='Tracks:', file=discord.File(tracklist_file, filename='tracklist.txt'))
 
@@ -1627,12 +3066,13 @@ async def import_tracklist(bot, context):
     try:
 
         # Get tracklist data from playlist URL
+        # Only the entry IDs and titles are listed, and only up to one past the limit
         if use_youtube_playlist:
-            downloader = YoutubeDL()
+            downloader = YoutubeDL({
+                'extract_flat': 'in_playlist', 'playlistend': IMPORT_LIMIT + 1, 'quiet': True})
             info = await utilities.future(
                 downloader.extract_info, context.options['youtube'], download=False)
-            # tracklist_data = list(it['webpage_url'] for it in info['entries'])
-            tracklist_data = info['entries']
+            tracklist_data = [_get_flat_entry(it) for it in info['entries'] if it]
 
         # Get tracklist data from file
         else:
@@ -1650,8 +3090,9 @@ async def import_tracklist(bot, context):
 
         if not tracklist_data or len(tracklist_data) == 0:
             raise CBException("The tracklist file is empty.")
-        elif len(tracklist_data) > 100:
-            raise CBException("Cannot import more than 100 tracks at a time.")
+        elif len(tracklist_data) > IMPORT_LIMIT:
+            raise CBException(
+                "Cannot import more than {} tracks at a time.".format(IMPORT_LIMIT))
     except Exception as e:
         data.remove(bot, __name__, 'import_lock', guild_id=context.guild.id, volatile=True)
         if isinstance(e, BotException):
@@ -1666,28 +3107,44 @@ async def import_tracklist(bot, context):
         extra_function=_import_tracklist_status)
 
 
+def _get_flat_entry(entry):
+    """Gets the URL, title, and duration (if listed) of a flat playlist entry."""
+    url = entry.get('url') or entry['id']
+    if not urlparse(url).scheme:  # Only the video ID is given
+        url = 'https://www.youtube.com/watch?v=' + url
+    flat_entry = {'webpage_url': url, 'title': entry.get('title') or url}
+    if entry.get('duration'):
+        flat_entry['duration'] = entry['duration']
+    return flat_entry
+
+
 async def _import_tracklist_status(bot, context, response):
+    """Imports tracks in stages: parse, check limits, extract concurrently, then insert.
+
+    Limits (and the hard threshold, where the duration is already known) are checked
+    before extraction, so tracks that would not be imported are never looked up.
+    """
     last_update_time = time.time()
-    total_imported = 0
+    total_extracted = 0
     tracklist_data, use_youtube_playlist = response.extra
+    workers = configurations.get(bot, __name__, key='import_workers')
+    hard_threshold = configurations.get(bot, __name__, key='hard_threshold')
 
-    async def _update_notification(last_update_time):
+    async def _update_notification():
+        nonlocal last_update_time
         if time.time() - last_update_time > 5:
+            last_update_time = time.time()
             await response.message.edit(content="Importing tracks... [ {} / {} ]".format(
-                total_imported, len(tracklist_data)))
-            return time.time()
-        return last_update_time
+                total_extracted, len(tracklist_data)))
 
+    # Parse the tracklist into (title, url, flat info, user ID, timestamp) in order
+    parsed = []
     try:
-
         if use_youtube_playlist:
             for info in tracklist_data:
-                await _add_track_to_db(
-                    bot, context.guild, info['webpage_url'], info,
-                    context.author.id, int(time.time()))
-                total_imported += 1
-                last_update_time = await _update_notification(last_update_time)
-
+                parsed.append((
+                    info['title'], info['webpage_url'], info,
+                    context.author.id, int(time.time())))
         else:
             if isinstance(tracklist_data, list):
                 tracklist_data = OrderedDict((it[0], it[1]) for it in enumerate(tracklist_data))
@@ -1701,20 +3158,67 @@ async def _import_tracklist_status(bot, context, response):
                 else:
                     title = url = track_blob
                     user_id, timestamp = context.author.id, time.time()
+                parsed.append((title, url, None, int(user_id), int(timestamp)))
+    except Exception as e:
+        data.remove(bot, __name__, 'import_lock', guild_id=context.guild.id, volatile=True)
+        raise CBException("Failed to import tracks.", e=e)
+
+    # Check limits in input order, and only keep the tracks before the first failure
+    failure = None
+    for index, (title, url, info, user_id, timestamp) in enumerate(parsed):
+        if info and info.get('duration', 0) > hard_threshold:
+            failure = (title, CBException(
+                "Song is longer than the hard threshold of {} seconds.".format(hard_threshold)))
+        else:
+            try:
+                _check_total_tracks_limits(bot, context.author, pending=index)
+            except BotException as e:
+                failure = (title, e)
+        if failure:
+            del parsed[index:]
+            break
+
+    # Extract metadata with a bounded number of concurrent workers
+    results = [None] * len(parsed)
+    first_failure = len(parsed)
+    semaphore = asyncio.Semaphore(workers)
+
+    async def _extract(index):
+        nonlocal total_extracted, first_failure
+        title, url, info, user_id, timestamp = parsed[index]
+        async with semaphore:
+            if index > first_failure:  # Would not be imported anyway
+                return
+            try:
+                url, info = await _extract_track_info(bot, url)  # Resolves flat entries
+                results[index] = await _get_track_entry(bot, url, info, user_id, timestamp)
+            except Exception as e:
+                results[index] = e
+                first_failure = min(first_failure, index)
+        total_extracted += 1
+        await _update_notification()
 
-                _check_total_tracks_limits(bot, context.author)
-                await _add_track_with_url(bot, context.guild, url, int(user_id), int(timestamp))
-                total_imported += 1
-                last_update_time = await _update_notification(last_update_time)
+    await asyncio.gather(*(_extract(index) for index in range(len(parsed))))
 
+    # Insert everything before the first failure
+    entries = []
+    for index, result in enumerate(results):
+        if isinstance(result, Exception):
+            failure = (parsed[index][0], result)
+            break
+        entries.append(result)
+
+    try:
+        if entries:
+            _insert_tracks(bot, context.guild, entries)
     except Exception as e:
         data.remove(bot, __name__, 'import_lock', guild_id=context.guild.id, volatile=True)
-        try:
-            raise CBException("Failed to import track {}".format(title), e=e)
-        except NameError:
-            raise CBException("Failed to import tracks.", e=e)
-
+        raise CBException("Failed to import tracks.", e=e)
     data.remove(bot, __name__, 'import_lock', guild_id=context.guild.id, volatile=True)
+    if failure:
+        raise CBException("Failed to import track {}".format(failure[0]), e=failure[1])
+
+    total_imported = len(entries)
     await response.message.edit(content="Imported {} track{}.".format(
         total_imported, '' if total_imported == 1 else 's'))
 
@@ -1744,7 +3248,7 @@ async def get_info(bot, context):
     if use_player_interface:  # Add notification
         track_link = _build_hyperlink(bot, track_info)
         info_text = "{}\n{}\n{}\n{}".format(response, track_link, duration_text, added_by_text)
-        music_player.page = int(index / 5)
+        music_player.page = int(index / PAGE_SIZE)
         await music_player.update_interface(notification_text=info_text, ignore_ratelimit=True)
         return Response(message_type=MessageTypes.REPLACE, extra=autodelete)
     else:
@@ -1959,6 +3463,7 @@ async def _confirm_clear_playlist(bot, context, response, result):
             raise CBException(
                 "Cannot clear playlist tracks when the player is active.", autodelete=autodelete)
         data.db_drop_table(bot, 'playlist', table_suffix=context.guild.id, safe=True)
+        _get_guild_tracklist(bot, context.guild).clear()
         edit = 'Playlist has been cleared.'
 
     else:
@@ -1974,9 +3479,8 @@ async def skip_to_page(bot, context):
         raise CBException("The player interface must be active.")
 
     # Check page number
-    tracklist = music_player.tracklist
     page_number = context.arguments[0] - 1
-    total_pages = max(int((len(tracklist) + 4) / 5), 1)
+    total_pages = music_player.guild_tracklist.total_pages
     if not 0 <= page_number <= total_pages - 1:
         raise CBException(
             "Invalid page number. Must be between 1 and {} inclusive.".format(total_pages),
@@ -2008,23 +3512,51 @@ async def swap_tracks(bot, context):
                 autodelete=autodelete)
         swap.append(tracklist[index - 1])
 
-    # Swap tracks
-    set_arg = (
-        '(url, downloadurl, title, duration, userid, timestamp, extra) = '
-        '(%s, %s, %s, %s, %s, %s, %s)')
+    # Swap the position keys of the tracks
     for index, track in enumerate(swap):
         data.db_update(
-            bot, 'playlist', table_suffix=context.guild.id,
-            set_arg=set_arg, where_arg='id=%s', input_args=[
-                track.url, track.downloadurl, track.title, track.duration, track.userid,
-                track.timestamp, Json(track.extra), swap[index - 1].id])
+            bot, 'playlist', table_suffix=context.guild.id, set_arg='position=%s',
+            where_arg='id=%s', input_args=[swap[index - 1].position, track.id])
+    _get_guild_tracklist(bot, context.guild).swap(*(it - 1 for it in context.arguments))
 
-    # Add notification and skip track if necessary
+    # Add notification and follow the current track
     response = '{} swapped tracks {} and {}'.format(context.author.mention, *context.arguments)
     if use_player_interface:
         music_player.update_tracklist()
-        if music_player.track_index + 1 in context.arguments:
-            asyncio.ensure_future(music_player.play(track_index=music_player.track_index))
+        music_player.update_track_index()
+        await music_player.update_interface(notification_text=response, ignore_ratelimit=True)
+        return Response(message_type=MessageTypes.REPLACE, extra=autodelete)
+    else:
+        return Response(content=response)
+
+
+async def move_track(bot, context):
+    """Moves the given track to a new place in the playlist."""
+    music_player, use_player_interface, autodelete = await _check_active_player(bot, context.guild)
+
+    # Check control restriction
+    control = data.get(
+        bot, __name__, 'control', guild_id=context.guild.id, default=Control.PARTIAL)
+    is_dj = data.has_custom_role(bot, __name__, 'dj', member=context.author)
+    if not is_dj and control != Control.ALL:
+        raise CBException("You must be a DJ to move tracks.", autodelete=autodelete)
+
+    # Check index validity
+    tracklist = _get_tracklist(bot, context.guild)
+    for index in context.arguments:
+        if not 1 <= index <= len(tracklist):
+            raise CBException(
+                "Index must be between 1 and {}".format(len(tracklist)),
+                autodelete=autodelete)
+    track_number, new_number = context.arguments
+    track = tracklist[track_number - 1]
+    _move_track(bot, context.guild, track, new_number - 1)
+
+    response = '{} moved track {} to {}'.format(
+        context.author.mention, track_number, _build_track_details(bot, track, new_number - 1))
+    if use_player_interface:
+        music_player.update_tracklist()
+        music_player.update_track_index()
         await music_player.update_interface(notification_text=response, ignore_ratelimit=True)
         return Response(message_type=MessageTypes.REPLACE, extra=autodelete)
     else:
@@ -2088,7 +3620,7 @@ async def control_player(bot, context):
         elif 'resume' in context.options:
             action = 'resume the player'
             assert permissions or music_player.autopaused or music_player.first_time_startup
-            asyncio.ensure_future(music_player.play(author=context.author))
+            music_player.request_play(author=context.author)
         else:
             if 'pause' in context.options:
                 action = 'pause the player'
@@ -2180,8 +3712,7 @@ async def setup_player(bot, context):
         if (len(message_history) > 2 and music_player.message.id in message_ids and
                 not context.subcommand.id == 'show'):
             if play_track:
-                asyncio.ensure_future(music_player.play(
-                    track_index=track_index, author=context.author))
+                music_player.request_play(track_index=track_index, author=context.author)
 
         else:
             await music_player.set_new_message(
@@ -2191,3 +3722,101 @@ async def setup_player(bot, context):
         # Delete any immediate play/skip commands, but keep track add messages.
         if not adding_track:
             return Response(message_type=MessageTypes.REPLACE)
+
+
+async def player_metrics(bot, context):
+    """Shows the aggregate metrics, or those of a single player."""
+    guild_id = context.options.get('guild')
+    if guild_id:
+        music_player = data.get(bot, __name__, 'music_player', guild_id=guild_id, volatile=True)
+        if not music_player:
+            raise CBException("No music player is active in that guild.")
+        metrics = music_player.metrics
+    else:
+        metrics = _get_player_metrics(bot)
+
+    if 'json' in context.options:
+        metrics_file = utilities.get_text_as_file(json.dumps(metrics.to_dict(), indent=4))
+        discord_file = discord.File(metrics_file, 'playlist_metrics.json')
+        return Response(content='Player metrics:', file=discord_file)
+
+    metrics_data = metrics.to_dict()
+    lines = ['Collected over {}'.format(utilities.get_time_string(int(metrics_data['uptime'])))]
+    for name, histogram in metrics_data['histograms'].items():
+        title = name.replace('_', ' ').capitalize()
+        if not histogram['count']:
+            lines.append('{}: no samples'.format(title))
+            continue
+        if name == 'download_size':  # Bytes
+            values = ['{:.2f} MB'.format(histogram[it] / 1000000) for it in ('mean', 'p90', 'max')]
+        else:
+            values = ['{:.3f} s'.format(histogram[it]) for it in ('mean', 'p90', 'max')]
+        lines.append('{}: {} samples, mean {}, p90 {}, max {}'.format(
+            title, histogram['count'], *values))
+    counters = metrics_data['counters']
+    cache_uses = counters['cache_hits'] + counters['cache_misses']
+    lines.append('Audio cache: {:.2%} hit ratio ({} hits, {} misses)'.format(
+        counters['cache_hits'] / cache_uses if cache_uses else 0,
+        counters['cache_hits'], counters['cache_misses']))
+    lines.append('Prefetch: {} hits, {} misses'.format(
+        counters['prefetch_hits'], counters['prefetch_misses']))
+    lines.append('Interface: {} edits, {} requests merged by the rate limit'.format(
+        counters['render_edits'], counters['edits_dropped']))
+    return Response(content='```\n{}```'.format('\n'.join(lines)))
+
+
+@plugins.listen_for('on_message')
+async def route_message(bot, message):
+    music_player = _get_player_router(bot).channels.get(message.channel.id)
+    if music_player:
+        music_player.handle_message(message)
+
+
+@plugins.listen_for('on_voice_state_update')
+async def route_voice_state(bot, member, before, after):
+    music_player = _get_player_router(bot).guilds.get(member.guild.id)
+    if music_player:
+        music_player.handle_voice_state(member, before, after)
+
+
+@plugins.listen_for('on_reaction_add')
+async def route_reaction(bot, reaction, user):
+    music_player = _get_player_router(bot).messages.get(reaction.message.id)
+    if music_player and not user.bot:
+        music_player.command_queue.put_nowait((reaction, user))
+
+
+async def _restore_player(bot, guild, checkpoint):
+    """Rebuilds the player of the guild from its checkpoint."""
+    channel = guild.get_channel(checkpoint['channel'])
+    voice_channel = guild.get_channel(checkpoint['voice_channel'])
+    if not (channel and voice_channel):  # Deleted since
+        data.remove(bot, __name__, 'checkpoint', guild_id=guild.id, safe=True)
+        return
+    for message_id in checkpoint['messages']:  # Old interface
+        try:
+            old_message = await channel.fetch_message(message_id)
+            await old_message.delete()
+        except Exception as e:
+            logger.debug("Failed to delete old player message %s: %s", message_id, e)
+    message = await channel.send(content='Restoring the music player...')
+    music_player = MusicPlayer(bot, message, checkpoint=checkpoint)
+    data.add(bot, __name__, 'music_player', music_player, guild_id=guild.id, volatile=True)
+    await message.delete()
+
+
+@plugins.listen_for('bot_on_ready_boot')
+async def setup_globals(bot):
+    """Keeps the tracks of active players in the audio cache and restores the players."""
+    bot.plugins['media_cache.py'].register_pins(bot, __name__, _get_pinned_tracks)
+    for guild in bot.guilds:
+        checkpoint = data.get(bot, __name__, 'checkpoint', guild_id=guild.id, default=None)
+        if not checkpoint:
+            continue
+        elif time.time() - checkpoint['time'] > CHECKPOINT_EXPIRY:
+            data.remove(bot, __name__, 'checkpoint', guild_id=guild.id, safe=True)
+            continue
+        try:  # The checkpoint is only replaced or removed once the player is restored
+            await _restore_player(bot, guild, checkpoint)
+        except Exception as e:
+            logger.warn("Failed to restore the player in guild %s: %s", guild.id, e)
@@ -0,0 +1,361 @@
+"""Out-of-process audio encoding for the music player.
+
+An audio node is a worker process that runs ffmpeg, applies the volume, and encodes
+Opus frames for any number of streams. The bot process only forwards control messages
+and hands the finished frames to the voice client, so decoding and encoding load runs
+on other cores instead of the event loop's process.
+
+Both ends use the same framing: a header (message kind, stream ID, payload length)
+followed by the payload. Control payloads are JSON, while audio data is sent as is.
+
+Running this file starts a node that talks over stdin and stdout.
+"""
+import subprocess
+import threading
+import struct
+import array
+import math
+import shlex
+import queue
+import json
+import sys
+
+import discord
+
+HEADER = struct.Struct('!BII')  # Kind, stream ID, payload length
+BUFFER_FRAMES = 150  # Frames (20 ms each) a node may encode ahead of playback
+CREDIT_BATCH = 50  # Frames played before the node is allowed to encode more
+FRAME_TIMEOUT = 10  # Seconds to wait on a frame before the stream is considered over
+INPUT_CHUNK = 64 * 1024  # Bytes forwarded from a pipe source at a time
+FRAME_DURATION = 0.02
+
+# Bot to node
+PLAY, DATA, DATA_END, VOLUME, CREDIT, STOP = range(6)
+# Node to bot
+FRAME, END = range(10, 12)
+
+
+def scale_pcm(pcm, volume):
+    """Scales 16-bit little-endian PCM samples by the volume, clipping them to range."""
+    samples = array.array('h', pcm)
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    if volume <= 1.0:  # Cannot go out of range
+        samples = array.array('h', [math.floor(it * volume) for it in samples])
+    else:
+        samples = array.array(
+            'h', [max(-32768, min(32767, math.floor(it * volume))) for it in samples])
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return samples.tobytes()
+
+
+def write_message(stream, lock, kind, stream_id, payload=b''):
+    with lock:
+        stream.write(HEADER.pack(kind, stream_id, len(payload)))
+        stream.write(payload)
+        stream.flush()
+
+
+def read_message(stream):
+    """Reads the next message. Returns None once the other end closes the stream."""
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    kind, stream_id, length = HEADER.unpack(header)
+    payload = stream.read(length) if length else b''
+    if len(payload) < length:
+        return None
+    return kind, stream_id, payload
+
+
+class AudioNodePool():
+    """Starts audio node processes and opens streams on the least busy one."""
+
+    def __init__(self, workers, logger=None):
+        self.nodes = []
+        self.workers = workers
+        self.logger = logger
+        self.lock = threading.Lock()
+
+    def open_stream(self, source, volume, before_options=None, bitrate=128):
+        """Opens a stream of the given file, URL, or pipe (file object) on a node.
+
+        Returns a NodeAudioSource that can be played by a voice client.
+        """
+        with self.lock:
+            self.nodes = [it for it in self.nodes if it.process.poll() is None]
+            if len(self.nodes) < self.workers:
+                self.nodes.append(AudioNodeProcess(self.logger))
+            node = min(self.nodes, key=lambda it: len(it.streams))
+        return node.open_stream(source, volume, before_options=before_options, bitrate=bitrate)
+
+    def close(self):
+        with self.lock:
+            for node in self.nodes:
+                node.close()
+            self.nodes = []
+
+
+class AudioNodeProcess():
+    """Bot side of a single node process. Routes incoming frames to their streams."""
+
+    def __init__(self, logger=None):
+        self.logger = logger
+        self.process = subprocess.Popen(
+            [sys.executable, __file__], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.write_lock = threading.Lock()
+        self.streams = {}  # Stream ID: NodeAudioSource
+        self.next_id = 1
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def send(self, kind, stream_id, payload=b''):
+        try:
+            write_message(self.process.stdin, self.write_lock, kind, stream_id, payload)
+        except (OSError, ValueError) as e:  # Node exited
+            if self.logger:
+                self.logger.warn("Failed to reach the audio node: %s", e)
+
+    def open_stream(self, source, volume, before_options=None, bitrate=128):
+        stream_id, self.next_id = self.next_id, self.next_id + 1
+        use_pipe = not isinstance(source, str)
+        audio_source = NodeAudioSource(self, stream_id, volume)
+        self.streams[stream_id] = audio_source
+        self.send(PLAY, stream_id, json.dumps({
+            'source': None if use_pipe else source,
+            'before_options': before_options,
+            'volume': volume,
+            'bitrate': bitrate
+        }).encode())
+        if use_pipe:
+            threading.Thread(target=self._forward, args=(stream_id, source), daemon=True).start()
+        return audio_source
+
+    def _forward(self, stream_id, pipe):
+        """Forwards the pipe source to the node as it arrives."""
+        try:
+            while stream_id in self.streams:
+                chunk = pipe.read(INPUT_CHUNK)
+                if not chunk:
+                    break
+                self.send(DATA, stream_id, chunk)
+        except (OSError, ValueError) as e:
+            if self.logger:
+                self.logger.warn("Failed to read the stream source: %s", e)
+        finally:
+            self.send(DATA_END, stream_id)
+            pipe.close()
+
+    def _read(self):
+        while True:
+            message = read_message(self.process.stdout)
+            if message is None:  # Node exited
+                break
+            kind, stream_id, payload = message
+            audio_source = self.streams.get(stream_id)
+            if audio_source is None:
+                continue
+            if kind == FRAME:
+                audio_source.frames.put(payload)
+            elif kind == END:
+                self.streams.pop(stream_id, None)
+                audio_source.frames.put(None)
+        for audio_source in list(self.streams.values()):
+            audio_source.frames.put(None)
+        self.streams.clear()
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+
+
+class NodeAudioSource(discord.AudioSource):
+    """Opus frames of a stream encoded by an audio node.
+
+    Playback position, volume, and stopping are controlled through the node, so
+    changing the volume does not restart the stream.
+    """
+
+    def __init__(self, node, stream_id, volume):
+        self.node = node
+        self.stream_id = stream_id
+        self._volume = volume
+        self.frames = queue.Queue()
+        self.frames_read = 0
+        self.ended = False
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        self._volume = value
+        self.node.send(VOLUME, self.stream_id, json.dumps(value).encode())
+
+    @property
+    def position(self):
+        """Seconds of audio read so far."""
+        return self.frames_read * FRAME_DURATION
+
+    def read(self):
+        if self.ended:
+            return b''
+        try:
+            frame = self.frames.get(timeout=FRAME_TIMEOUT)
+        except queue.Empty:
+            frame = None
+        if frame is None:
+            self.ended = True
+            return b''
+        self.frames_read += 1
+        if self.frames_read % CREDIT_BATCH == 0:
+            self.node.send(CREDIT, self.stream_id, json.dumps(CREDIT_BATCH).encode())
+        return frame
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.ended = True
+        if self.node.streams.pop(self.stream_id, None):  # Still running on the node
+            self.node.send(STOP, self.stream_id)
+
+
+class NodeStream():
+    """Node side of a stream: decodes with ffmpeg, applies the volume, and encodes Opus."""
+
+    def __init__(self, node, stream_id, options):
+        self.node = node
+        self.stream_id = stream_id
+        self.volume = options['volume']
+        self.bitrate = options['bitrate']
+        self.credit = BUFFER_FRAMES
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.input = None if options['source'] else queue.Queue()
+        arguments = ['ffmpeg', '-nostdin', '-loglevel', 'warning']
+        if options['before_options']:
+            arguments += shlex.split(options['before_options'])
+        arguments += [
+            '-i', options['source'] or 'pipe:0',
+            '-f', 's16le', '-ar', '48000', '-ac', '2', 'pipe:1']
+        self.process = subprocess.Popen(
+            arguments, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            stdin=subprocess.PIPE if self.input else subprocess.DEVNULL)
+
+    def start(self):
+        threading.Thread(target=self._encode, daemon=True).start()
+        if self.input:
+            threading.Thread(target=self._write_input, daemon=True).start()
+
+    def add_credit(self, frames):
+        with self.condition:
+            self.credit += frames
+            self.condition.notify_all()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.input:
+            self.input.put(None)
+        self.process.kill()
+
+    def _write_input(self):
+        try:
+            while True:
+                chunk = self.input.get()
+                if chunk is None:
+                    break
+                self.process.stdin.write(chunk)
+        except OSError:  # ffmpeg exited
+            pass
+        finally:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+
+    def _encode(self):
+        frame_size = discord.opus.Encoder.FRAME_SIZE
+        try:
+            encoder = discord.opus.Encoder()
+            encoder.set_bitrate(self.bitrate)
+            while True:
+                with self.condition:
+                    while self.credit <= 0 and not self.stopped:
+                        self.condition.wait()
+                    if self.stopped:
+                        break
+                    self.credit -= 1
+                pcm = self.process.stdout.read(frame_size)
+                if not pcm:
+                    break
+                if len(pcm) < frame_size:
+                    pcm += b'\x00' * (frame_size - len(pcm))
+                if self.volume != 1.0:
+                    pcm = scale_pcm(pcm, min(self.volume, 2.0))
+                self.node.send(
+                    FRAME, self.stream_id,
+                    encoder.encode(pcm, discord.opus.Encoder.SAMPLES_PER_FRAME))
+        finally:
+            self.process.kill()
+            self.node.finish(self.stream_id)
+
+
+class AudioNode():
+    """Node process main loop. Reads control messages and runs a NodeStream for each."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.write_lock = threading.Lock()
+        self.streams = {}
+
+    def send(self, kind, stream_id, payload=b''):
+        write_message(self.writer, self.write_lock, kind, stream_id, payload)
+
+    def finish(self, stream_id):
+        if self.streams.pop(stream_id, None):
+            self.send(END, stream_id)
+
+    def run(self):
+        while True:
+            message = read_message(self.reader)
+            if message is None:  # Bot exited
+                break
+            kind, stream_id, payload = message
+            if kind == PLAY:
+                try:
+                    stream = NodeStream(self, stream_id, json.loads(payload))
+                except Exception as e:
+                    print("Failed to start stream {}: {}".format(stream_id, e), file=sys.stderr)
+                    self.send(END, stream_id)
+                else:
+                    self.streams[stream_id] = stream
+                    stream.start()
+                continue
+            stream = self.streams.get(stream_id)
+            if stream is None:
+                continue
+            elif kind == DATA:
+                stream.input.put(payload)
+            elif kind == DATA_END:
+                stream.input.put(None)
+            elif kind == VOLUME:
+                stream.volume = json.loads(payload)
+            elif kind == CREDIT:
+                stream.add_credit(json.loads(payload))
+            elif kind == STOP:
+                self.streams.pop(stream_id, None)
+                stream.stop()
+        for stream in list(self.streams.values()):
+            stream.stop()
+
+
+if __name__ == '__main__':
+    AudioNode(sys.stdin.buffer, sys.stdout.buffer).run()
@@ -0,0 +1,35 @@
+"""Tests of the audio node helpers.
+
+Usage: python -m unittest discover playlist/tests
+"""
+import unittest
+import struct
+import sys
+import os
+
+PLUGIN_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PLUGIN_DIRECTORY, 'plugin_data'))
+
+import audio_node
+
+
+def _pack(*samples):
+    return struct.pack('<{}h'.format(len(samples)), *samples)
+
+
+class TestScalePCM(unittest.TestCase):
+
+    def test_scales_down(self):
+        self.assertEqual(
+            audio_node.scale_pcm(_pack(1000, -1000, 3), 0.5), _pack(500, -500, 1))
+
+    def test_rounds_down(self):
+        self.assertEqual(audio_node.scale_pcm(_pack(3, -3), 0.5), _pack(1, -2))
+
+    def test_clips_when_amplified(self):
+        self.assertEqual(
+            audio_node.scale_pcm(_pack(20000, -20000, 100), 2.0), _pack(32767, -32768, 200))
+
+
+if __name__ == '__main__':
+    unittest.main()
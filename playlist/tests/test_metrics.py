@@ -0,0 +1,50 @@
+"""Tests of the music player metrics.
+
+Usage: python -m unittest discover playlist/tests
+"""
+import importlib.util
+import unittest
+import sys
+import os
+
+PLUGIN_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PLUGIN_DIRECTORY, 'plugin_data'))
+
+
+def _load_playlist():
+    spec = importlib.util.spec_from_file_location(
+        'playlist.py', os.path.join(PLUGIN_DIRECTORY, 'playlist.py'))
+    playlist = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(playlist)
+    return playlist
+
+
+playlist = _load_playlist()
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_overflow_bucket(self):
+        histogram = playlist.Histogram(playlist.TIME_BUCKETS)
+        histogram.add(0.2)
+        histogram.add(playlist.TIME_BUCKETS[-1] * 2)
+        result = histogram.to_dict()
+        self.assertEqual(result['max'], playlist.TIME_BUCKETS[-1] * 2)
+        self.assertEqual(result['p99'], playlist.TIME_BUCKETS[-1] * 2)
+        self.assertEqual(result['buckets']['inf'], 1)
+
+    def test_percentile_capped_at_maximum(self):
+        histogram = playlist.Histogram(playlist.TIME_BUCKETS)
+        histogram.add(0.2)
+        self.assertEqual(histogram.get_percentile(0.9), 0.2)
+
+    def test_player_metrics_with_overflow(self):
+        metrics = playlist.PlayerMetrics(parent=playlist.PlayerMetrics())
+        metrics.observe('download_size', playlist.SIZE_BUCKETS[-1] + 1)
+        self.assertEqual(
+            metrics.parent.to_dict()['histograms']['download_size']['p50'],
+            playlist.SIZE_BUCKETS[-1] + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+"""Tests of the stream tee that plays uncached tracks while they are downloaded.
+
+No network or ffmpeg is used. The download writes a local payload instead, and
+ffmpeg is replaced by a script that reads a little of its input and then stalls,
+like an ffmpeg process that is no longer being read from.
+
+Usage: python -m unittest discover playlist/tests
+"""
+import importlib.util
+import unittest
+import tempfile
+import asyncio
+import stat
+import sys
+import os
+
+import discord
+
+PLUGIN_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PLUGIN_DIRECTORY, 'plugin_data'))
+
+PAYLOAD_SIZE = 4 * 1024 * 1024  # Well over the size of a pipe buffer
+THREAD_TIMEOUT = 5  # Seconds to wait on the feeder thread to exit
+STALLED_FFMPEG = (
+    '#!{}\n'
+    'import sys, time\n'
+    'sys.stdin.buffer.read(4096)\n'
+    'time.sleep(60)\n').format(sys.executable)
+
+
+def _load_playlist():
+    spec = importlib.util.spec_from_file_location(
+        'playlist.py', os.path.join(PLUGIN_DIRECTORY, 'playlist.py'))
+    playlist = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(playlist)
+    return playlist
+
+
+playlist = _load_playlist()
+
+
+class LocalStreamTee(playlist.StreamTee):
+    """Stream tee that downloads a local payload and does not add it to the cache."""
+
+    async def _download(self):
+        for _ in range(0, PAYLOAD_SIZE, playlist.STREAM_CHUNK):
+            self.cache_file.write(b'\x00' * playlist.STREAM_CHUNK)
+            self.cache_file.flush()
+            with self.condition:
+                self.received += playlist.STREAM_CHUNK
+                self.condition.notify_all()
+            if not self.started.done():
+                self.started.set_result(True)
+            await asyncio.sleep(0)
+        self._finish()
+
+
+class TestStreamTee(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        file_descriptor, self.ffmpeg = tempfile.mkstemp()
+        with os.fdopen(file_descriptor, 'w') as ffmpeg_file:
+            ffmpeg_file.write(STALLED_FFMPEG)
+        os.chmod(self.ffmpeg, stat.S_IRWXU)
+        self.stream_tee = None
+
+    def tearDown(self):
+        if self.stream_tee:
+            self.stream_tee._discard()
+        os.remove(self.ffmpeg)
+        self.loop.close()
+
+    def test_skip_mid_stream_stops_feeder(self):
+        self.loop.run_until_complete(self._skip_mid_stream())
+
+    async def _skip_mid_stream(self):
+        self.stream_tee = LocalStreamTee(None, 'https://example.com/track', 'track')
+        await self.stream_tee.start()
+        audio_source = discord.PCMVolumeTransformer(
+            playlist.TeeAudioSource(self.stream_tee, executable=self.ffmpeg))
+        await self.stream_tee.download_task
+        self.assertTrue(self.stream_tee.feeder.is_alive())  # Blocked on the full pipe
+
+        audio_source.cleanup()  # Called by the voice client when the track is skipped
+        self.stream_tee.feeder.join(THREAD_TIMEOUT)
+        self.assertFalse(self.stream_tee.feeder.is_alive())
+        self.assertTrue(self.stream_tee.pipe.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
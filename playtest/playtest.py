@@ -1,7 +1,7 @@
 import discord
-from youtube_dl import YoutubeDL
+import os
 
-from jshbot import utilities, configurations, plugins, data, logger
+from jshbot import utilities, configurations, plugins, logger
 from jshbot.exceptions import ConfiguredBotException, BotException
 from jshbot.commands import (
     Command, SubCommand, Shortcut, ArgTypes, Attachment, Arg, Opt, MessageTypes, Response)
@@ -22,18 +22,27 @@ async def get_response(bot, context):
         voice_channel = context.author.voice.channel
         voice_client = await utilities.join_and_ready(bot, voice_channel)
 
-        options = {'format': 'bestaudio/best', 'noplaylist': True}
-        downloader = YoutubeDL(options)
         url = context.arguments[0]
         try:
-            file_location = data.get_from_cache(bot, None, url=url)
+            media_cache = bot.plugins['media_cache.py']
+            file_location = media_cache.get_audio(bot, url)
             if not file_location:
                 logger.info("Not found in cache. Downloading...")
-                info = await utilities.future(downloader.extract_info, url, download=False)
+                info = await media_cache.extract_info(bot, url, streams=True)
                 download_url = info['formats'][0]['url']
-                file_location = await data.add_to_cache(bot, download_url, name=url)
+                file_location = await media_cache.add_audio(bot, download_url, name=url)
             ffmpeg_options = '-protocol_whitelist "file,http,https,tcp,tls"'
-            voice_client.play(discord.FFmpegPCMAudio(file_location, before_options=ffmpeg_options))
+
+            def _remove_uncached(error):  # Files too large for the cache are not kept
+                if not media_cache.owns_file(bot, file_location):
+                    try:
+                        os.remove(file_location)
+                    except OSError:
+                        pass
+
+            voice_client.play(
+                discord.FFmpegPCMAudio(file_location, before_options=ffmpeg_options),
+                after=_remove_uncached)
         except BotException as e:
             raise e  # Pass up
         except Exception as e:
@@ -1,17 +1,16 @@
 import asyncio
 import discord
 import random
+import heapq
 import pprint
 import yaml
 import time
 import re
 import io
 
-from collections import OrderedDict
+from collections import OrderedDict, Counter, namedtuple
 from discord.abc import PrivateChannel
 from psycopg2.extras import Json
-from youtube_dl import YoutubeDL
-from tinytag import TinyTag
 
 from jshbot import data, utilities, configurations, logger, plugins, parser
 from jshbot.exceptions import BotException, ConfiguredBotException
@@ -26,6 +25,12 @@ CBException = ConfiguredBotException('Tags')
 FLAG_LIST = ['Sound', 'Private', 'NSFW', 'Complex', 'Random']
 SIMPLE_FLAG_LIST = list(it.lower() for it in FLAG_LIST)
 USE_GLOBAL_TAGS, REPLACE_COMMANDS, RANDOM_TAG_LIMIT = False, False, 200  # Set by on_ready
+Tag = namedtuple('Tag', (
+    'key', 'value', 'length', 'volume', 'name', 'flags', 'author', 'hits', 'created',
+    'last_used', 'last_used_by', 'complex', 'extra'))  # Same order as tags_template
+NGRAM_SIZES = (2, 3)  # Bigrams keep transposed letters in short names similar
+SIMILARITY_THRESHOLD = 0.3  # Minimum similarity of "did you mean" suggestions
+SIMILAR_SEARCH_LIMIT = 10  # Similar tags listed by a search without exact matches
 
 
 # Converts the input (value) into a tag tuple
@@ -100,6 +105,107 @@ class TagConverter():
         return tag
 
 
+class TagIndex():
+    """Tags of recently used guilds kept in memory, so lookups skip the database.
+
+    The tags of a table are loaded with a single query on first use, then kept current
+    by every write (write-through). Once more than guild_limit tables are loaded, the
+    least recently used ones are dropped and loaded again when needed.
+
+    Each table also has an n-gram index (n-gram: keys that contain it) for similar
+    name suggestions and substring searches.
+    """
+
+    def __init__(self, bot, guild_limit):
+        self.bot = bot
+        self.guild_limit = guild_limit
+        self.tables = OrderedDict()  # Table suffix: {key: Tag}, or None if there is no table
+        self.ngrams = {}  # Table suffix: {n-gram: set of keys}
+
+    def get_tags(self, table_suffix):
+        """Gets the tags of the table by key, or None if the table does not exist."""
+        table_suffix = str(table_suffix)
+        if table_suffix in self.tables:
+            self.tables.move_to_end(table_suffix)
+            return self.tables[table_suffix]
+        cursor = data.db_select(self.bot, from_arg='tags', table_suffix=table_suffix)
+        tags = {it.key: Tag._make(it) for it in cursor.fetchall()} if cursor else None
+        self.tables[table_suffix] = tags
+        self.ngrams[table_suffix] = {}
+        for key in tags or []:
+            self._index_key(table_suffix, key)
+        while len(self.tables) > self.guild_limit:
+            evicted_suffix, _ = self.tables.popitem(last=False)
+            del self.ngrams[evicted_suffix]
+        return tags
+
+    def add(self, table_suffix, tag):
+        table_suffix = str(table_suffix)
+        if table_suffix in self.tables:
+            if self.tables[table_suffix] is None:  # Table was just created
+                self.tables[table_suffix] = {}
+            self.tables[table_suffix][tag.key] = tag
+            self._index_key(table_suffix, tag.key)
+
+    def remove(self, table_suffix, key):
+        table_suffix = str(table_suffix)
+        tags = self.tables.get(table_suffix)
+        if tags and tags.pop(key, None):
+            ngram_index = self.ngrams[table_suffix]
+            for ngram in _get_ngrams(key):
+                ngram_index[ngram].discard(key)
+                if not ngram_index[ngram]:
+                    del ngram_index[ngram]
+
+    def get_similar(self, table_suffix, key, limit=3):
+        """Gets up to limit tags with names similar to the given key, most similar first.
+
+        Similarity is the number of shared n-grams over the number of distinct n-grams
+        of both names.
+        """
+        tags = self.get_tags(table_suffix)
+        if not tags:
+            return []
+        ngrams = _get_ngrams(key)
+        ngram_index = self.ngrams[str(table_suffix)]
+        shared = Counter()
+        for ngram in ngrams:
+            shared.update(ngram_index.get(ngram, ()))
+        scored = []
+        for match, count in shared.items():
+            similarity = count / (len(ngrams) + len(_get_ngrams(match)) - count)
+            if similarity >= SIMILARITY_THRESHOLD:
+                scored.append((similarity, match))
+        best = heapq.nsmallest(limit, scored, key=lambda it: (-it[0], it[1]))
+        return [tags[match] for _, match in best]
+
+    def get_containing(self, table_suffix, text):
+        """Gets the tags with the text in their key, sorted by key."""
+        tags = self.get_tags(table_suffix)
+        if not tags:
+            return []
+        size = min(len(text), max(NGRAM_SIZES))
+        if size < min(NGRAM_SIZES):  # Too short to narrow down
+            candidates = tags
+        else:  # Keys containing the text contain all of its n-grams
+            ngram_index = self.ngrams[str(table_suffix)]
+            candidates = set.intersection(*(
+                ngram_index.get(text[it:it + size], set())
+                for it in range(len(text) - size + 1)))
+        return [tags[it] for it in sorted(candidates) if text in it]
+
+    def _index_key(self, table_suffix, key):
+        ngram_index = self.ngrams[table_suffix]
+        for ngram in _get_ngrams(key):
+            ngram_index.setdefault(ngram, set()).add(key)
+
+    def add_hit(self, table_suffix, key, user_id, last_used):
+        tags = self.tables.get(str(table_suffix))
+        if tags and key in tags:
+            tag = tags[key]
+            tags[key] = tag._replace(hits=tag.hits + 1, last_used=last_used, last_used_by=user_id)
+
+
 @plugins.command_spawner
 def get_commands(bot):
     global USE_GLOBAL_TAGS, RANDOM_TAG_LIMIT
@@ -267,9 +373,7 @@ async def tag_create(bot, context):
     test = _get_tag(bot, cleaned_tag_name, context.guild.id, safe=True)
     if test:
         raise CBException("Tag `{}` already exists.".format(_format_tag(test)))
-    cursor = data.db_select(
-        bot, select_arg='COUNT(*)', from_arg='tags', table_suffix=str(context.guild.id))
-    if cursor is not None and cursor.fetchone().count >= tag_limit:
+    if _get_tag_count(bot, context.guild.id) >= tag_limit:
         raise CBException("The tag limit of {} has been reached.".format(tag_limit))
 
     if 'random' in context.options:
@@ -424,6 +528,7 @@ async def tag_edit(bot, context):
     tag = options['edit']
     flags = _get_flags(tag.flags, simple=True)
     new_tag = list(tag)
+    new_tag[1], new_tag[2] = list(tag.value), list(tag.length)  # Indexed tag is not changed
     additions = []
 
     if 'set' in options:
@@ -545,10 +650,7 @@ async def tag_list(bot, context):
             raise CBException("You are not on any servers shared by the bot.")
     else:
         buttons = ['⬅', '➡']
-        cursor = data.db_select(
-            bot, select_arg='COUNT(*)', from_arg='tags', table_suffix=str(context.guild.id))
-        tag_count = cursor.fetchone().count if cursor else 0
-        if tag_count == 0:
+        if _get_tag_count(bot, context.guild.id) == 0:
             raise CBException("This server has no tags.")
         guilds = [context.guild]
 
@@ -564,7 +666,7 @@ async def tag_list(bot, context):
 
 
 async def tag_search(bot, context):
-    terms = context.arguments[0]
+    terms = _cleaned_tag_name(context.arguments[0])
     if not terms:
         raise CBException("Try some text next time, knucklehead")
     if context.direct:  # Search tags from all guilds
@@ -574,16 +676,17 @@ async def tag_search(bot, context):
             raise CBException("You are not on any servers shared by the bot.")
     else:
         buttons = ['⬅', '➡']
-        cursor = data.db_select(
-            bot, select_arg='COUNT(*)', from_arg='tags', table_suffix=str(context.guild.id))
-        tag_count = cursor.fetchone().count if cursor else 0
-        if tag_count == 0:
+        if _get_tag_count(bot, context.guild.id) == 0:
             raise CBException("This server has no tags.")
         guilds = [context.guild]
-    guild_tags, tag_blob = _get_guild_tags(bot, guilds, 'key LIKE %s', ['%'+terms+'%'])
-    if not guild_tags:
-        raise CBException("No tags found.")
-    filter_text = "Tags with `{}` in it:".format(terms)
+    guild_tags, tag_blob = _get_guild_tags(bot, guilds, search=terms)
+    if guild_tags:
+        filter_text = "Tags with `{}` in it:".format(terms)
+    else:  # Suggest similar tags instead
+        guild_tags, tag_blob = _get_guild_tags(bot, guilds, search=terms, similar=True)
+        if not guild_tags:
+            raise CBException("No tags found.")
+        filter_text = "No tags with `{}` in it. Similar tags:".format(terms)
     return _build_tag_list_response(context, buttons, guild_tags, tag_blob, filter_text)
 
 
@@ -856,9 +959,7 @@ async def _import_tag_status(bot, context, response):
             except NameError:
                 raise CBException("Failed to import tags", e=e)
 
-    cursor = data.db_select(
-        bot, select_arg='COUNT(*)', from_arg='tags', table_suffix=str(context.guild.id))
-    if cursor is not None and cursor.fetchone().count - overwrites + len(new_tags) > tag_limit:
+    if _get_tag_count(bot, context.guild.id) - overwrites + len(new_tags) > tag_limit:
         raise CBException(
             "Total tags (original and imported) exceed tag limit ({}).".format(tag_limit))
 
@@ -891,21 +992,25 @@ async def tag_retrieve(bot, context):
 
 async def _play_sound_tag(bot, tag, url, voice_channel, elevation=0, delay=30):
     """Plays the given tag in the voice channel."""
-    sound_file = data.get_from_cache(bot, None, url=url)
+    media_cache = bot.plugins['media_cache.py']
+    sound_tag_hits = data.get(bot, __name__, 'sound_tag_hits', volatile=True)
+    if sound_tag_hits is None:
+        sound_tag_hits = {}
+        data.add(bot, __name__, 'sound_tag_hits', sound_tag_hits, volatile=True)
+    sound_tag_hits[url] = tag.hits + 1
+    sound_file = media_cache.get_audio(bot, url)
     if not sound_file:  # Can't reuse URLs unfortunately
         if url.startswith('https://my.mixtape.moe/'):
             download_url = url
         else:
             try:
-                ytdl_options = {'format': 'bestaudio/best', 'noplaylist': True}
-                downloader = YoutubeDL(ytdl_options)
-                info = await utilities.future(downloader.extract_info, url, download=False)
+                info = await media_cache.extract_info(bot, url, streams=True)
                 download_url = info['formats'][0]['url']
             except Exception as e:
                 logger.warn("youtube_dl failed to download file.")
                 logger.warn("Exception information: {}".format(e))
                 raise CBException("Failed to download the file.", e=e)
-        sound_file = await data.add_to_cache(bot, download_url, name=url)
+        sound_file = await media_cache.add_audio(bot, download_url, name=url)
 
     # TODO: Check ffmpeg options?
     ffmpeg_options = '-protocol_whitelist "file,crypto,http,https,tcp,tls"'
@@ -978,20 +1083,16 @@ def _get_tag(bot, tag_name, guild_id, safe=False):
     else:
         table_suffix = str(guild_id)
     key = _cleaned_tag_name(tag_name)
-    cursor = data.db_select(
-        bot, from_arg='tags', table_suffix=table_suffix, where_arg='key=%s', input_args=[key])
-    if cursor is None:
+    tags = _get_tag_index(bot).get_tags(table_suffix)
+    if tags is None:
         if safe:
             return None
         raise CBException("This server has no tags.")
-    tag = cursor.fetchone()
+    tag = tags.get(key)
     if not tag:  # Look for similar names
         if safe:
             return None
-        cursor = data.db_select(
-            bot, from_arg='tags', table_suffix=table_suffix, limit=3,
-            where_arg='key LIKE %s', input_args=['%' + key + '%'])
-        matches = cursor.fetchall()
+        matches = _get_tag_index(bot).get_similar(table_suffix, key)
         if matches:
             suggestion = "Did you mean: `{}`".format(
                 '`, `'.join(_format_tag(tag) for tag in matches))
@@ -1015,42 +1116,68 @@ def _add_tag(bot, tag_data, guild_id, replace=False):
     data.db_insert(
         bot, 'tags', input_args=tag_data, table_suffix=guild_id,
         safe=False, create='tags_template')
+    tag = Tag._make(tag_data)._replace(complex=tag_data[11].adapted, extra=tag_data[12].adapted)
+    _get_tag_index(bot).add(guild_id, tag)
 
 
 def _remove_tag(bot, tag_name, guild_id):
     data.db_delete(
         bot, 'tags', table_suffix=guild_id, where_arg='key=%s', input_args=[tag_name], safe=False)
+    _get_tag_index(bot).remove(guild_id, tag_name)
 
 
 def _update_hits(bot, cleaned_tag_name, user_id, guild_id):
     """Increments the hit counter on the given tag."""
+    last_used = int(time.time())
     data.db_update(
         bot, 'tags', table_suffix=guild_id, set_arg='hits=hits+1, last_used=%s, last_used_by=%s',
-        where_arg='key=%s', input_args=[int(time.time()), user_id, cleaned_tag_name])
+        where_arg='key=%s', input_args=[last_used, user_id, cleaned_tag_name])
+    _get_tag_index(bot).add_hit(guild_id, cleaned_tag_name, user_id, last_used)
+
+
+def _get_ngrams(text):
+    """Gets the n-grams of the text, padded with spaces to weigh the start and end."""
+    ngrams = set()
+    for size in NGRAM_SIZES:
+        padded = ' ' * (size - 1) + text + ' '
+        ngrams.update(padded[it:it + size] for it in range(len(padded) - size + 1))
+    return ngrams
+
+
+def _get_tag_index(bot):
+    tag_index = data.get(bot, __name__, 'tag_index', volatile=True)
+    if tag_index is None:
+        tag_index = TagIndex(bot, configurations.get(bot, __name__, 'indexed_guilds'))
+        data.add(bot, __name__, 'tag_index', tag_index, volatile=True)
+    return tag_index
+
+
+def _get_tag_count(bot, guild_id):
+    """Gets the number of tags in the guild table."""
+    return len(_get_tag_index(bot).get_tags(guild_id) or {})
 
 
 async def _get_checked_durations(bot, urls):
     length_limit = configurations.get(bot, __name__, 'max_sound_tag_length')
-    downloader = YoutubeDL({'format': 'worstaudio/worst', 'noplaylist': True})
+    media_cache = bot.plugins['media_cache.py']
     lengths = []
     over_limit = []
     for url in urls:
         try:
-            info = await utilities.future(downloader.extract_info, url, download=False)
+            info = await media_cache.extract_info(bot, url)
+            if 'duration' not in info:  # Stream URLs are needed for the manual check
+                info = await media_cache.extract_info(bot, url, streams=True)
             if 'duration' in info:
                 duration = int(info['duration'])
-            else:  # Manual download and check
+            else:  # Probe the file without downloading all of it
                 bot.extra = info
                 if info.get('direct', False):
                     chosen_format = info
                 else:
                     chosen_format = info['formats'][0]
-                extension = chosen_format['ext']
-                download_url = chosen_format['url']
-                file_location, filename = await utilities.download_url(
-                    bot, download_url, extension=extension, include_name=True)
-                duration = int(TinyTag.get(file_location).duration)
-                utilities.delete_temporary_file(bot, filename)
+                duration = int(await media_cache.probe_duration(
+                    bot, chosen_format['url'], extension=chosen_format.get('ext'),
+                    limit=length_limit, headers=chosen_format.get('http_headers')))
         except BotException as e:
             raise e  # Pass up
         except Exception as e:
@@ -1068,15 +1195,30 @@ async def _get_checked_durations(bot, urls):
         return lengths
 
 
-def _get_guild_tags(bot, guilds, where_arg='', input_args='', flag_strip=[]):
+def _get_guild_tags(
+        bot, guilds, where_arg='', input_args='', flag_strip=[], search=None, similar=False):
+    """Gets the formatted tag listing of each guild.
+
+    Keyword arguments:
+    search -- Only lists tags containing this text (from the tag index instead).
+    similar -- Lists tags with names similar to the search text instead.
+    """
     guild_tags = OrderedDict()
+    tag_index = _get_tag_index(bot)
     for guild in guilds:
-        cursor = data.db_select(
-            bot, from_arg='tags', table_suffix=guild.id, where_arg=where_arg,
-            input_args=input_args, additional='ORDER BY key ASC')
-        if cursor is None:
-            continue
-        found_tags = cursor.fetchall()
+        if search and similar:
+            found_tags = sorted(
+                tag_index.get_similar(guild.id, search, limit=SIMILAR_SEARCH_LIMIT),
+                key=lambda it: it.key)
+        elif search:
+            found_tags = tag_index.get_containing(guild.id, search)
+        else:
+            cursor = data.db_select(
+                bot, from_arg='tags', table_suffix=guild.id, where_arg=where_arg,
+                input_args=input_args, additional='ORDER BY key ASC')
+            if cursor is None:
+                continue
+            found_tags = cursor.fetchall()
         if len(found_tags) == 0:
             continue
         guild_tags[guild.name] = {'total': len(found_tags), 'listing': []}
@@ -1191,6 +1333,13 @@ async def _tag_list_browser(bot, context, response, result, timed_out):
     await response.message.edit(embed=response.embed)
 
 
+def _get_pinned_sound_tags(bot):
+    """Gets the URLs of the most used sound tags (as of their last use)."""
+    limit = configurations.get(bot, __name__, 'pinned_sound_tags')
+    sound_tag_hits = data.get(bot, __name__, 'sound_tag_hits', volatile=True, default={})
+    return sorted(sound_tag_hits, key=sound_tag_hits.get, reverse=True)[:limit]
+
+
 @plugins.listen_for('bot_on_ready_boot')
 async def setup_globals(bot):
     """Sets up the configuration globals."""
@@ -1198,6 +1347,9 @@ async def setup_globals(bot):
     USE_GLOBAL_TAGS = configurations.get(bot, __name__, 'global_tags')
     REPLACE_COMMANDS = configurations.get(bot, __name__, 'replace_commands')
 
+    # Keep the most used sound tags in the audio cache
+    bot.plugins['media_cache.py'].register_pins(bot, __name__, _get_pinned_sound_tags)
+
     # TODO: Properly fix this IDNAError issue. In the meantime, a workaround:
     # Forgive me, Father, for I have sinned
     import idna